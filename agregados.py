@@ -0,0 +1,88 @@
+import logging
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple, Type
+from sqlmodel import SQLModel, Session, select, insert, delete, func, extract, col
+from sqlalchemy import tuple_
+import clean_db
+from clean_db import Expediente
+
+# Tablas de agregados del portal (totales por órgano y adjudicatario, por órgano y mes, por CPV y por procedimiento).
+# La carga anota las claves de los expedientes que inserta o modifica, y solo esas claves se recalculan a partir
+# de los expedientes, con un INSERT ... SELECT agrupado en la propia base de datos
+
+# Número de claves por sentencia
+TAM_BLOQUE = 500
+
+# Cada agregado: modelo, expresiones de su clave sobre Expediente y la misma clave calculada sobre una fila de expediente.
+# Los expedientes con algún valor de la clave vacío no cuentan en ese agregado
+AGREGADOS: List[Tuple[Type[SQLModel], List[Any], Callable[[Dict[str, Any]], Tuple]]] = [
+    (clean_db.TotalOrganoAdjudicatario, [Expediente.id_organo, Expediente.adjudicatario_id],
+     lambda exp: (exp["id_organo"], exp["adjudicatario_id"])),
+    (clean_db.TotalOrganoMes, [Expediente.id_organo, extract("year", Expediente.fecha_anuncio), extract("month", Expediente.fecha_anuncio)],
+     lambda exp: (exp["id_organo"],) + ((exp["fecha_anuncio"].year, exp["fecha_anuncio"].month) if exp["fecha_anuncio"] is not None else (None, None))),
+    (clean_db.TotalCPV, [Expediente.codigo_CPV], lambda exp: (exp["codigo_CPV"],)),
+    (clean_db.TotalProcedimiento, [Expediente.procedimiento], lambda exp: (exp["procedimiento"],)),
+]
+# Columnas de Expediente de las que dependen las claves
+COLUMNAS_CLAVE = ["id_organo", "adjudicatario_id", "fecha_anuncio", "codigo_CPV", "procedimiento"]
+
+def _columnas_clave(modelo: Type[SQLModel]) -> List[Any]:
+    return list(modelo.__table__.primary_key.columns)
+
+# Condición "la clave está en la lista" para una o varias columnas
+def _en_claves(columnas: List[Any], claves: List[Tuple]):
+    if len(columnas) == 1:
+        return col(columnas[0]).in_([clave[0] for clave in claves])
+    return tuple_(*columnas).in_(claves)
+
+# Claves de los agregados que dependen de cada modelo
+class Tocados:
+    def __init__(self):
+        self.claves: Dict[Type[SQLModel], Set[Tuple]] = defaultdict(set)
+
+    # Anota las claves de unas filas de expediente (diccionarios con las columnas de COLUMNAS_CLAVE)
+    def añade(self, filas: Iterable[Dict[str, Any]]):
+        for exp in filas:
+            for modelo, _, clave in AGREGADOS:
+                valores = clave(exp)
+                if None not in valores:
+                    self.claves[modelo].add(valores)
+
+    # Anota las claves que tienen ahora los expedientes indicados, antes de modificarlos
+    def añade_existentes(self, session: Session, ids: List[int]):
+        columnas = [getattr(Expediente, c) for c in COLUMNAS_CLAVE]
+        for i in range(0, len(ids), TAM_BLOQUE):
+            self.añade(session.execute(select(*columnas).where(col(Expediente.internal_id).in_(ids[i:i + TAM_BLOQUE]))).mappings())
+
+    def __len__(self) -> int:
+        return sum(len(claves) for claves in self.claves.values())
+
+# Inserta en el agregado las filas agrupadas de los expedientes que cumplen el filtro
+def _inserta_agrupados(session: Session, modelo: Type[SQLModel], expresiones: List[Any], *filtro):
+    consulta = (select(*expresiones, func.count(), func.sum(Expediente.importe_adjudicacion))
+                .where(*filtro, *[e != None for e in expresiones])
+                .group_by(*expresiones))
+    nombres = [c.name for c in _columnas_clave(modelo)] + ["num_expedientes", "importe_total"]
+    session.execute(insert(modelo).from_select(nombres, consulta))
+
+# Recalcula las claves anotadas en la transacción de la sesión, sin hacer commit, y vacía la lista
+def recalcula(session: Session, tocados: Tocados):
+    for modelo, expresiones, _ in AGREGADOS:
+        claves = list(tocados.claves.pop(modelo, ()))
+        for i in range(0, len(claves), TAM_BLOQUE):
+            bloque = claves[i:i + TAM_BLOQUE]
+            session.execute(delete(modelo).where(_en_claves(_columnas_clave(modelo), bloque)))
+            _inserta_agrupados(session, modelo, expresiones, _en_claves(expresiones, bloque))
+
+# Vuelve a calcular todos los agregados, sin hacer commit
+def reconstruye(session: Session):
+    for modelo, expresiones, _ in AGREGADOS:
+        session.execute(delete(modelo))
+        _inserta_agrupados(session, modelo, expresiones)
+    logging.info("Agregados reconstruidos")
+
+# Si hay expedientes pero los agregados están vacíos (bases de datos anteriores a los agregados) hay que reconstruirlos
+def faltan_agregados(session: Session) -> bool:
+    hay_expedientes = session.exec(select(Expediente.internal_id).limit(1)).first() is not None
+    hay_agregados = any(session.exec(select(*_columnas_clave(modelo)).limit(1)).first() is not None for modelo, _, _ in AGREGADOS)
+    return hay_expedientes and not hay_agregados
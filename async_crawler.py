@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+import extractor_html
+import http_fetch
+import scraping_params
+
+# Descarga una página de detalle reintentando con espera exponencial, devuelve None si se agotan los intentos
+async def _descarga_con_reintentos(cab: Dict[str, Any], args: Any, semaforo: asyncio.Semaphore) -> Optional[http_fetch.RespuestaHtml]:
+    for intento in range(args.retries + 1):
+        async with semaforo:
+            respuesta = await asyncio.to_thread(http_fetch.descarga_html_condicional, cab["url de descarga"], args)
+        if respuesta is not None:
+            return respuesta
+        if intento < args.retries:
+            await asyncio.sleep(args.backoff * 2 ** intento * random.uniform(0.5, 1.5))
+
+    logging.error("No se pudo descargar el expediente %s tras %d intentos, se descargará con el navegador", cab["Nombre del expediente"], args.retries + 1)
+    return None
+
+# Descarga y procesa un expediente y lo entrega a guarda. Las cabeceras cuyas páginas necesitan JavaScript, no se pueden
+# descargar o no se pueden procesar pasan a la lista de las que se descargan con el navegador
+async def _procesa_cabecera(cab: Dict[str, Any], args: Any, semaforo: asyncio.Semaphore,
+                            guarda: Callable[[Dict[str, Any]], None], pendientes_navegador: List[Dict[str, Any]], fallidas: List[str]):
+    respuesta = await _descarga_con_reintentos(cab, args, semaforo)
+    if respuesta is None:
+        fallidas.append(cab["url de descarga"])
+        pendientes_navegador.append(cab)
+        return
+    if not extractor_html.contiene_detalle(respuesta.texto):
+        pendientes_navegador.append(cab)
+        return
+    try:
+        expediente = await asyncio.to_thread(scraping_params.expediente_desde_html, cab, respuesta.texto, respuesta.etag, respuesta.last_modified)
+    except Exception as e:
+        logging.error("Error al procesar el expediente %s, se descargará con el navegador: %s", cab["Nombre del expediente"], e)
+        fallidas.append(cab["url de descarga"])
+        pendientes_navegador.append(cab)
+        return
+    # Fuera del bucle de eventos: la escritura de un lote completo no debe parar las descargas
+    await asyncio.to_thread(guarda, expediente)
+
+async def _descarga_expedientes(args: Any, lista_cabeceras: List[Dict[str, Any]],
+                                guarda: Callable[[Dict[str, Any]], None]) -> List[Dict[str, Any]]:
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=args.concurrency))
+    semaforo = asyncio.Semaphore(args.concurrency)
+    pendientes_navegador = []
+    fallidas = []
+
+    await asyncio.gather(*(_procesa_cabecera(cab, args, semaforo, guarda, pendientes_navegador, fallidas) for cab in lista_cabeceras))
+    if fallidas:
+        logging.warning("%d de %d expedientes fallaron por HTTP y pasan al navegador: %s", len(fallidas), len(lista_cabeceras), ", ".join(fallidas))
+
+    return pendientes_navegador
+
+# Descarga de forma concurrente los expedientes de la lista de cabeceras y entrega cada uno a la función guarda,
+# que se encarga de agruparlos en lotes (EscritorExpedientes.añade).
+# Devuelve las cabeceras que deben descargarse con el navegador: las que necesitan JavaScript y las que fallan por HTTP
+def descarga_expedientes(args: Any, lista_cabeceras: List[Dict[str, Any]], guarda: Callable[[Dict[str, Any]], None]) -> List[Dict[str, Any]]:
+    if not lista_cabeceras:
+        return []
+    return asyncio.run(_descarga_expedientes(args, lista_cabeceras, guarda))
@@ -0,0 +1,122 @@
+import argparse
+import gzip
+import hashlib
+import logging
+from typing import Dict, Optional, Tuple
+from sqlmodel import SQLModel, Field, Session, select, col
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+import storage
+
+# zstandard es opcional: si no está instalado las páginas se comprimen con gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Almacén de las páginas HTML de los expedientes, direccionado por contenido: cada página distinta se guarda
+# una sola vez y comprimida, y los expedientes solo guardan su hash
+
+GZIP = "gzip"
+ZSTD = "zstd"
+CODEC = ZSTD if zstandard is not None else GZIP
+
+# Número de filas que se migran en cada transacción
+TAM_BLOQUE = 500
+
+# Página HTML comprimida
+class HtmlBlob(SQLModel, table=True):
+    hash: str = Field(primary_key=True)
+    codec: str
+    datos: bytes
+
+    # HTML descomprimido
+    @property
+    def html(self) -> bytes:
+        return descomprime(self.codec, self.datos)
+
+# Hash del contenido de una página de detalle
+def hash_html(page: Optional[bytes]) -> Optional[str]:
+    if page is None:
+        return None
+    return hashlib.sha256(page).hexdigest()
+
+def comprime(datos: bytes) -> Tuple[str, bytes]:
+    if CODEC == ZSTD:
+        return ZSTD, zstandard.ZstdCompressor(level=10).compress(datos)
+    return GZIP, gzip.compress(datos)
+
+def descomprime(codec: str, datos: bytes) -> bytes:
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("La página está comprimida con zstd y el paquete zstandard no está instalado")
+        return zstandard.ZstdDecompressor().decompress(datos)
+    return gzip.decompress(datos)
+
+# Guarda las páginas (hash -> HTML) que no estén ya en el almacén, sin hacer commit para que entren
+# en la misma transacción que los expedientes que las usan
+def guarda_paginas(db: Session, paginas: Dict[str, bytes]):
+    if not paginas:
+        return
+    existentes = set(db.exec(select(HtmlBlob.hash).where(col(HtmlBlob.hash).in_(list(paginas)))).all())
+    filas = []
+    for hash_pagina, pagina in paginas.items():
+        if hash_pagina not in existentes:
+            codec, datos = comprime(bytes(pagina))
+            filas.append(dict(hash=hash_pagina, codec=codec, datos=datos))
+    if filas:
+        storage.carga_masiva(db, HtmlBlob, filas)
+
+# Mueve al almacén las páginas que las versiones anteriores guardaban en la columna Html_page de expedienteraw
+# y elimina la columna. No hace nada si la base de datos ya no tiene la columna
+def migra_paginas_en_linea(engine: Engine):
+    inspector = inspect(engine)
+    if not inspector.has_table("expedienteraw"):
+        return
+    columnas = {c["name"] for c in inspector.get_columns("expedienteraw")}
+    if "Html_page" not in columnas:
+        return
+
+    # Las bases de datos anteriores al almacén tampoco tienen la columna con el hash de la página
+    if "hash_html" not in columnas:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE expedienteraw ADD COLUMN hash_html VARCHAR"))
+    logging.info("Moviendo las páginas HTML de expedienteraw al almacén comprimido")
+    migradas = 0
+    ultimo_id = 0
+    with Session(engine) as db:
+        while True:
+            filas = db.execute(text('SELECT id, "Html_page" FROM expedienteraw WHERE id > :id AND "Html_page" IS NOT NULL ORDER BY id LIMIT :n'),
+                               {"id": ultimo_id, "n": TAM_BLOQUE}).all()
+            if not filas:
+                break
+            hashes = [(id_exp, hash_html(bytes(pagina))) for id_exp, pagina in filas]
+            guarda_paginas(db, {hash_pagina: pagina for (_, hash_pagina), (_, pagina) in zip(hashes, filas)})
+            db.execute(text('UPDATE expedienteraw SET hash_html = :hash, "Html_page" = NULL WHERE id = :id'),
+                       [{"hash": hash_pagina, "id": id_exp} for id_exp, hash_pagina in hashes])
+            db.commit()
+            migradas += len(filas)
+            ultimo_id = filas[-1][0]
+            logging.info("%d páginas migradas", migradas)
+
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE expedienteraw DROP COLUMN "Html_page"'))
+    if storage.es_sqlite(engine):
+        # Devuelve al sistema el espacio que ocupaban las páginas sin comprimir
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+
+def read_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--database", type=str, default=storage.RAW_URL, help=f"URL de la base de datos cruda (default={storage.RAW_URL})")
+
+    args = parser.parse_args()
+
+    return args
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = read_params()
+    engine = storage.engine(args.database)
+    SQLModel.metadata.create_all(engine, tables=[HtmlBlob.__table__])
+    migra_paginas_en_linea(engine)
@@ -1,10 +1,13 @@
-from sqlmodel import Field, SQLModel, create_engine, Session, select, Relationship, Column
+from sqlmodel import Field, SQLModel, Session, select, Relationship, Column
 from pydantic.v1 import AnyUrl, validator
 from typing import Optional, List
 from datetime import datetime
+from sqlalchemy import Index
 import unidecode
+import storage
+import migraciones
 
-DATABASE_URL = "sqlite:///clean_database.db"
+DATABASE_URL = storage.CLEAN_URL
 
 class OrganoContratacion(SQLModel, table=True):
     __tablename__ = "OrganoContratacion"
@@ -21,11 +24,12 @@ class OrganoContratacion(SQLModel, table=True):
 class Adjudicatario(SQLModel, table=True):
     __tablename__ = "Adjudicatario"
     internal_id: int|None = Field(default=None, primary_key=True)
-    nombre: str|None = Field(default= None)
+    nombre: str|None = Field(default= None, unique=True, index=True)
     nif: str|None = Field(default=None)
     url: str|None = Field(default=None)
     nombres_similares: Optional[str] = Field(default=None)  # Nuevo campo para nombres similares
     num_nombres_similares: int | None = Field(default=0)  # Nuevo campo para número de nombres similares
+    id_grupo: int|None = Field(default=None, index=True)  # internal_id del representante de los nombres de la misma empresa
     
     lista_adjudicaciones: list["Expediente"] = Relationship(back_populates="adjudicatario_final")
 
@@ -34,10 +38,17 @@ class Adjudicatario(SQLModel, table=True):
 
 class Expediente(SQLModel, table=True):
     __tablename__ = "Expediente"
+    # Índices de las consultas del portal: expedientes de un órgano por importe o por fecha, y últimos contratos por estado
+    __table_args__ = (
+        Index("ix_Expediente_organo_importe", "id_organo", "importe_adjudicacion"),
+        Index("ix_Expediente_organo_fecha_fin", "id_organo", "fecha_fin_oferta"),
+        Index("ix_Expediente_estado_fecha_fin", "estado_lic", "fecha_fin_oferta"),
+    )
+
     internal_id: int|None = Field(default=None, primary_key=True)
     timetrack: datetime = Field(default= datetime.now())
     fecha_anuncio: datetime|None = Field(default= None)
-    nombre_exp: str|None = Field(default= None)
+    nombre_exp: str|None = Field(default= None, unique=True, index=True)
     route: str|None = Field(default= None)
     id_organo: int|None = Field(default= None, foreign_key="OrganoContratacion.id")
     organo_contratacion: str|None = Field(default= None)
@@ -53,9 +64,10 @@ class Expediente(SQLModel, table=True):
     procedimiento: str|None = Field(default= None) # Puede ser categorical
     tipo_tramitacion: str|None = Field(default= None) # Puede ser categorical
     metodo_presentacion: str|None = Field(default= None) # Puede ser categorical
-    fecha_fin_oferta: datetime|None = Field(default= None)
+    fecha_fin_oferta: datetime|None = Field(default= None, index=True)
     resultado: str|None = Field(default= None) # Puede ser categorical
-    adjudicatario: str|None = Field(default= None, foreign_key="Adjudicatario.nombre")
+    adjudicatario: str|None = Field(default= None)  # Nombre tal como aparece en el expediente
+    adjudicatario_id: int|None = Field(default= None, foreign_key="Adjudicatario.internal_id", index=True)
     n_licitadores: int|None = Field(default= None)
     importe_adjudicacion: float|None = Field(default= None)
     fecha_fin_solicitud: datetime|None = Field(default= None)
@@ -73,9 +85,58 @@ class Expediente(SQLModel, table=True):
     def __repr__(self) -> str:
         return f"<ID del expediente = {self.nombre_exp}, Estado de la licitación = {self.estado_lic}"
     
-def connect_db(): 
-    engine = create_engine(DATABASE_URL)
-    SQLModel.metadata.create_all(engine)
+# Índice LSH de los nombres de adjudicatarios: una fila por banda de la firma MinHash de cada adjudicatario
+class BandaAdjudicatario(SQLModel, table=True):
+    __tablename__ = "BandaAdjudicatario"
+    banda: str = Field(primary_key=True)
+    adjudicatario_id: int = Field(primary_key=True, foreign_key="Adjudicatario.internal_id")
+
+# Marca de agua de la carga incremental: último expediente crudo procesado de cada base de datos cruda
+class EstadoETL(SQLModel, table=True):
+    __tablename__ = "EstadoETL"
+    fuente: str = Field(primary_key=True)
+    ultimo_id: int = Field(default=0)
+    ultimo_timetrack: datetime|None = Field(default=None)
+    actualizado: datetime|None = Field(default=None)
+
+# Agregados de los expedientes para el portal, los mantiene agregados.py en cada carga.
+# Cada fila tiene el número de expedientes y el importe adjudicado total de su clave
+class TotalOrganoAdjudicatario(SQLModel, table=True):
+    __tablename__ = "TotalOrganoAdjudicatario"
+    id_organo: int = Field(primary_key=True)
+    adjudicatario_id: int = Field(primary_key=True)
+    num_expedientes: int = Field(default=0)
+    importe_total: float|None = Field(default=None)
+
+# Por mes de la fecha de anuncio
+class TotalOrganoMes(SQLModel, table=True):
+    __tablename__ = "TotalOrganoMes"
+    id_organo: int = Field(primary_key=True)
+    anio: int = Field(primary_key=True)
+    mes: int = Field(primary_key=True)
+    num_expedientes: int = Field(default=0)
+    importe_total: float|None = Field(default=None)
+
+class TotalCPV(SQLModel, table=True):
+    __tablename__ = "TotalCPV"
+    codigo_CPV: str = Field(primary_key=True)
+    num_expedientes: int = Field(default=0)
+    importe_total: float|None = Field(default=None)
+
+class TotalProcedimiento(SQLModel, table=True):
+    __tablename__ = "TotalProcedimiento"
+    procedimiento: str = Field(primary_key=True)
+    num_expedientes: int = Field(default=0)
+    importe_total: float|None = Field(default=None)
+
+# Tablas de la base de datos limpia
+TABLAS = [OrganoContratacion.__table__, Adjudicatario.__table__, Expediente.__table__, BandaAdjudicatario.__table__, EstadoETL.__table__,
+          TotalOrganoAdjudicatario.__table__, TotalOrganoMes.__table__, TotalCPV.__table__, TotalProcedimiento.__table__]
+
+def connect_db(url: str = DATABASE_URL): 
+    engine = storage.engine(url)
+    migraciones.migra(engine)
+    storage.crea_tablas(engine, TABLAS)
     return engine
 
 
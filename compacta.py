@@ -0,0 +1,101 @@
+import argparse
+import logging
+from itertools import groupby
+from typing import Any, Dict, List
+from sqlmodel import Session, select, delete, col
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+import raw_db
+from raw_db import ExpedienteRaw
+from blob_store import HtmlBlob
+import storage
+
+# Compacta la base de datos cruda: las versiones antiguas de los expedientes que no cumplen la política de retención
+# pasan a una base de datos de archivo junto con sus páginas, y se libera el espacio que ocupaban
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Número de versiones que se archivan en cada transacción
+TAM_BLOQUE = 500
+
+def read_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--database", type=str, default=raw_db.DATABASE_URL, help=f"URL de la base de datos cruda (default={raw_db.DATABASE_URL})")
+    parser.add_argument("-a", "--archive", type=str, default=storage.ARCHIVE_URL, help=f"URL de la base de datos de archivo (default={storage.ARCHIVE_URL})")
+    parser.add_argument("-k", "--keep-last", type=int, default=3, help="Versiones antiguas de cada expediente que se conservan además de la reciente (default=3)")
+    parser.add_argument("-m", "--monthly", action="store_true", help="Conserva también la última versión de cada mes de cada expediente")
+
+    args = parser.parse_args()
+
+    return args
+
+# Ids de las versiones antiguas que no cumplen la política de retención. La versión reciente siempre se conserva
+def versiones_a_archivar(db: Session, mantener: int, mensual: bool = False) -> List[int]:
+    statement = (select(ExpedienteRaw.id, ExpedienteRaw.nombre, ExpedienteRaw.timetrack, ExpedienteRaw.reciente)
+                 .order_by(ExpedienteRaw.nombre, col(ExpedienteRaw.timetrack).desc(), col(ExpedienteRaw.id).desc()))
+    archivar = []
+    for _, versiones in groupby(db.exec(statement), key=lambda v: v[1]):
+        antiguas = 0
+        meses = set()
+        for id_exp, _, timetrack, reciente in versiones:
+            if reciente:
+                continue
+            antiguas += 1
+            mes = (timetrack.year, timetrack.month)
+            if antiguas <= mantener or (mensual and mes not in meses):
+                meses.add(mes)
+                continue
+            archivar.append(id_exp)
+    return archivar
+
+# Copia al archivo las versiones indicadas y sus páginas y las borra de la base de datos cruda
+def _archiva_bloque(db: Session, archivo: Session, ids: List[int]):
+    filas: List[Dict[str, Any]] = [exp.model_dump(exclude={"id"}) for exp in db.exec(select(ExpedienteRaw).where(col(ExpedienteRaw.id).in_(ids)))]
+    hashes = {fila["hash_html"] for fila in filas if fila["hash_html"] is not None}
+    if hashes:
+        ya_archivados = set(archivo.exec(select(HtmlBlob.hash).where(col(HtmlBlob.hash).in_(hashes))).all())
+        blobs = [dict(hash=b.hash, codec=b.codec, datos=b.datos)
+                 for b in db.exec(select(HtmlBlob).where(col(HtmlBlob.hash).in_(hashes - ya_archivados)))]
+        if blobs:
+            storage.carga_masiva(archivo, HtmlBlob, blobs)
+    storage.carga_masiva(archivo, ExpedienteRaw, filas)
+    # Primero se confirma el archivo: si se interrumpe entre los dos commits las versiones quedan duplicadas, no se pierden
+    archivo.commit()
+    db.execute(delete(ExpedienteRaw).where(col(ExpedienteRaw.id).in_(ids)))
+    db.commit()
+
+# Borra las páginas que ya no usa ninguna versión
+def borra_paginas_huerfanas(db: Session) -> int:
+    usadas = select(ExpedienteRaw.hash_html).where(ExpedienteRaw.hash_html != None)
+    resultado = db.execute(delete(HtmlBlob).where(col(HtmlBlob.hash).not_in(usadas)))
+    db.commit()
+    return resultado.rowcount
+
+# Devuelve al sistema las páginas libres del fichero SQLite. La primera vez activa auto_vacuum incremental,
+# lo que necesita un VACUUM completo; después basta con incremental_vacuum
+def libera_espacio(engine: Engine):
+    if not storage.es_sqlite(engine):
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() != 2:
+            logging.info("Activando auto_vacuum incremental, se reescribe la base de datos completa")
+            conn.execute(text("PRAGMA auto_vacuum=INCREMENTAL"))
+            conn.execute(text("VACUUM"))
+        else:
+            conn.execute(text("PRAGMA incremental_vacuum"))
+
+# Archiva las versiones antiguas según la política de retención, borra las páginas huérfanas y libera el espacio
+def compacta(engine: Engine, engine_archivo: Engine, mantener: int, mensual: bool = False) -> int:
+    with Session(engine) as db, Session(engine_archivo) as archivo:
+        ids = versiones_a_archivar(db, mantener, mensual)
+        logging.info("%d versiones antiguas para archivar", len(ids))
+        for i in range(0, len(ids), TAM_BLOQUE):
+            _archiva_bloque(db, archivo, ids[i:i + TAM_BLOQUE])
+            logging.info("%d versiones archivadas", min(i + TAM_BLOQUE, len(ids)))
+        logging.info("%d páginas huérfanas borradas", borra_paginas_huerfanas(db))
+    libera_espacio(engine)
+    return len(ids)
+
+if __name__ == "__main__":
+    args = read_params()
+    compacta(raw_db.connect_db(args.database), raw_db.connect_db(args.archive), args.keep_last, args.monthly)
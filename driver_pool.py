@@ -0,0 +1,116 @@
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Optional
+from selenium import webdriver
+from selenium.webdriver.remote.webdriver import WebDriver
+from selenium.webdriver.chrome.options import Options
+
+# Crea un navegador nuevo con las opciones de los argumentos de entrada
+def crea_driver(args: Any) -> WebDriver:
+    options = Options()
+    # En modo paralelo los navegadores se abren siempre sin ventana
+    if args.headless or args.workers > 1:
+        options.add_argument("--headless=new")
+
+    driver = webdriver.Chrome(options=options)
+    driver.implicitly_wait(args.patience)
+    driver.paginas_visitadas = 0
+
+    return driver
+
+# Anota una página cargada en el navegador para decidir cuándo reciclarlo
+def registra_pagina(driver: WebDriver, n: int = 1):
+    driver.paginas_visitadas = getattr(driver, "paginas_visitadas", 0) + n
+
+# Comprueba que la sesión del navegador sigue respondiendo
+def driver_vivo(driver: WebDriver) -> bool:
+    try:
+        driver.current_url
+        return True
+    except Exception:
+        return False
+
+# Conjunto de navegadores calientes que se reutilizan entre órganos y entre etapas del scraping
+class DriverPool:
+    def __init__(self, args: Any, size: Optional[int] = None, max_paginas: Optional[int] = None):
+        self.args = args
+        self.size = max(1, size if size is not None else args.workers)
+        self.max_paginas = max_paginas if max_paginas is not None else args.recycle
+        self._libres: List[WebDriver] = []
+        self._en_uso: List[WebDriver] = []
+        self._lock = threading.Lock()
+        self._huecos = threading.BoundedSemaphore(self.size)
+
+    # Entrega un navegador libre, reutilizando el más reciente o creando uno nuevo si no hay
+    def adquiere(self) -> WebDriver:
+        self._huecos.acquire()
+        try:
+            while True:
+                with self._lock:
+                    driver = self._libres.pop() if self._libres else None
+                if driver is None:
+                    driver = crea_driver(self.args)
+                    break
+                if driver_vivo(driver):
+                    break
+                logging.warning("Navegador caído, se descarta y se abre otro")
+                self._cierra_driver(driver)
+        except Exception:
+            self._huecos.release()
+            raise
+
+        with self._lock:
+            self._en_uso.append(driver)
+        return driver
+
+    # Devuelve un navegador al pool, o lo cierra si ha fallado o ha superado el número de páginas
+    def libera(self, driver: WebDriver, roto: bool = False):
+        with self._lock:
+            if driver in self._en_uso:
+                self._en_uso.remove(driver)
+        try:
+            if roto or getattr(driver, "paginas_visitadas", 0) >= self.max_paginas:
+                self._cierra_driver(driver)
+            else:
+                with self._lock:
+                    self._libres.append(driver)
+        finally:
+            self._huecos.release()
+
+    # Presta un navegador durante un bloque with, opcionalmente navegando a una url
+    @contextmanager
+    def navegador(self, link: Optional[str] = None) -> Iterator[WebDriver]:
+        driver = self.adquiere()
+        roto = False
+        try:
+            if link:
+                driver.get(link)
+                registra_pagina(driver)
+            yield driver
+        except Exception:
+            roto = not driver_vivo(driver)
+            raise
+        finally:
+            self.libera(driver, roto)
+
+    # Cierra todos los navegadores del pool
+    def cierra(self):
+        with self._lock:
+            drivers = self._libres + self._en_uso
+            self._libres = []
+            self._en_uso = []
+        for driver in drivers:
+            self._cierra_driver(driver)
+
+    def _cierra_driver(self, driver: WebDriver):
+        try:
+            driver.quit()
+        except Exception as e:
+            logging.error("Error al cerrar el navegador: %s", e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cierra()
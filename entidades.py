@@ -0,0 +1,190 @@
+import hashlib
+import logging
+import re
+import zlib
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+import unidecode
+from sqlmodel import Session, select, update, col
+import clean_db
+import storage
+
+# Resolución de entidades de los adjudicatarios: agrupa los nombres que corresponden a la misma empresa.
+# Se agrupan los que comparten NIF y, para el resto, los que tienen nombres parecidos. Los candidatos se buscan con un
+# índice MinHash-LSH de n-gramas de caracteres guardado en la base de datos limpia, así que cada carga solo compara
+# los adjudicatarios nuevos y no todos contra todos
+
+# Parámetros de MinHash-LSH: NUM_BANDAS bandas de FILAS_BANDA valores. Dos nombres con similitud de Jaccard s
+# comparten alguna banda con probabilidad 1 - (1 - s^FILAS_BANDA)^NUM_BANDAS (≈ 0.5 para s = 0.5, ≈ 0.98 para s = 0.8)
+NUM_BANDAS = 16
+FILAS_BANDA = 4
+NUM_HASHES = NUM_BANDAS * FILAS_BANDA
+TAM_NGRAMA = 3
+# Similitud de Jaccard mínima entre los n-gramas de dos nombres para considerarlos la misma empresa
+UMBRAL_SIMILITUD = 0.7
+
+# Coeficientes fijos de las permutaciones para que las firmas sean las mismas en todas las ejecuciones
+_PRIMO = (1 << 31) - 1
+_generador = np.random.default_rng(20240601)
+_A = _generador.integers(1, _PRIMO, NUM_HASHES, dtype=np.uint64)
+_B = _generador.integers(0, _PRIMO, NUM_HASHES, dtype=np.uint64)
+
+# Formas jurídicas que se ignoran al comparar nombres
+FORMAS_JURIDICAS = re.compile(r"\b(S ?L ?U|S ?L ?L|S ?L|S ?A ?U|S ?A|S ?C ?A|S ?COOP|SOC COOP|U ?T ?E|C ?B|SOCIEDAD (LIMITADA|ANONIMA)( UNIPERSONAL)?|SOCIEDAD COOPERATIVA( ANDALUZA)?)\b")
+# NIF/CIF español dentro del texto del adjudicatario
+PATRON_NIF = re.compile(r"\b([A-HJ-NP-SUVW]\d{7}[0-9A-J]|\d{8}[A-Z]|[XYZ]\d{7}[A-Z])\b")
+
+# Mayúsculas sin acentos ni signos de puntuación y con los espacios normalizados
+def normaliza_nombre(nombre: str) -> str:
+    nombre = unidecode.unidecode(nombre.upper())
+    nombre = re.sub(r"[^\w\s]", " ", nombre)
+    return " ".join(nombre.split())
+
+# Nombre normalizado sin NIF ni forma jurídica, que es lo que se compara
+def clave_comparacion(nombre: str) -> str:
+    clave = normaliza_nombre(nombre)
+    clave = PATRON_NIF.sub(" ", clave)
+    clave = FORMAS_JURIDICAS.sub(" ", clave)
+    return " ".join(clave.split())
+
+def extrae_nif(nombre: str) -> Optional[str]:
+    encontrado = PATRON_NIF.search(unidecode.unidecode(nombre.upper()).replace("-", ""))
+    return encontrado.group(1) if encontrado else None
+
+def ngramas(clave: str) -> Set[str]:
+    texto = f" {clave} "
+    if len(texto) <= TAM_NGRAMA:
+        return {texto}
+    return {texto[i:i + TAM_NGRAMA] for i in range(len(texto) - TAM_NGRAMA + 1)}
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+# Firma MinHash de un conjunto de n-gramas, calculada para todas las permutaciones a la vez
+def firma_minhash(conjunto: Set[str]) -> np.ndarray:
+    valores = np.array([zlib.crc32(g.encode("utf-8")) for g in conjunto], dtype=np.uint64)
+    return ((_A[:, None] * valores[None, :] + _B[:, None]) % _PRIMO).min(axis=1)
+
+# Claves de las bandas de una firma, que son las que se guardan en el índice
+def bandas(firma: np.ndarray) -> List[str]:
+    return [f"{b}:{hashlib.md5(firma[b * FILAS_BANDA:(b + 1) * FILAS_BANDA].tobytes()).hexdigest()[:16]}" for b in range(NUM_BANDAS)]
+
+# Conjuntos disjuntos para unir los adjudicatarios de la misma empresa
+class UnionFind:
+    def __init__(self):
+        self.padre: Dict[int, int] = {}
+
+    def busca(self, x: int) -> int:
+        self.padre.setdefault(x, x)
+        raiz = x
+        while self.padre[raiz] != raiz:
+            raiz = self.padre[raiz]
+        while self.padre[x] != raiz:
+            self.padre[x], x = raiz, self.padre[x]
+        return raiz
+
+    # Une los conjuntos de a y b, el representante es el menor id
+    def une(self, a: int, b: int):
+        ra, rb = self.busca(a), self.busca(b)
+        if ra != rb:
+            self.padre[max(ra, rb)] = min(ra, rb)
+
+def _en_bloques(valores: List, tam: int = 500) -> Iterable[List]:
+    for i in range(0, len(valores), tam):
+        yield valores[i:i + tam]
+
+# Agrupa los adjudicatarios que aún no tienen grupo con los ya agrupados y entre sí, y actualiza nombres_similares
+# en los grupos que han cambiado. Los adjudicatarios ya agrupados no se vuelven a comparar entre ellos
+def resuelve_adjudicatarios(session: Session) -> int:
+    Adj = clean_db.Adjudicatario
+    nuevos = session.exec(select(Adj.internal_id, Adj.nombre, Adj.nif).where(Adj.id_grupo == None, Adj.nombre != None)).all()
+    if not nuevos:
+        return 0
+
+    uf = UnionFind()
+    grupo_actual: Dict[int, int] = {}  # id -> id_grupo guardado de los adjudicatarios ya agrupados que se tocan
+    conjuntos: Dict[int, Set[str]] = {}
+    nifs: Dict[int, str] = {}
+    filas_bandas = []
+    por_banda: Dict[str, List[int]] = defaultdict(list)
+    for internal_id, nombre, nif in nuevos:
+        uf.busca(internal_id)
+        nif = nif or extrae_nif(nombre)
+        if nif:
+            nifs[internal_id] = nif
+        conjuntos[internal_id] = ngramas(clave_comparacion(nombre))
+        for banda in bandas(firma_minhash(conjuntos[internal_id])):
+            por_banda[banda].append(internal_id)
+            filas_bandas.append(dict(banda=banda, adjudicatario_id=internal_id))
+
+    # Mismo NIF: entre los nuevos y con los ya agrupados
+    por_nif: Dict[str, List[int]] = defaultdict(list)
+    for internal_id, nif in nifs.items():
+        por_nif[nif].append(internal_id)
+    for bloque in _en_bloques(list(por_nif)):
+        for internal_id, nif, id_grupo in session.exec(select(Adj.internal_id, Adj.nif, Adj.id_grupo).where(col(Adj.nif).in_(bloque), Adj.id_grupo != None)):
+            por_nif[nif].append(internal_id)
+            grupo_actual[internal_id] = id_grupo
+    for ids in por_nif.values():
+        for otro in ids[1:]:
+            uf.une(ids[0], otro)
+
+    # Candidatos por nombre: los que comparten alguna banda, entre los nuevos y en el índice guardado
+    candidatos: Set[Tuple[int, int]] = set()
+    for bloque in _en_bloques(list(por_banda)):
+        for banda, adjudicatario_id in session.exec(select(clean_db.BandaAdjudicatario.banda, clean_db.BandaAdjudicatario.adjudicatario_id)
+                                                     .where(col(clean_db.BandaAdjudicatario.banda).in_(bloque))):
+            por_banda[banda].append(adjudicatario_id)
+    for ids in por_banda.values():
+        for i, a in enumerate(ids):
+            for b in ids[i + 1:]:
+                if a != b and (a in conjuntos or b in conjuntos):
+                    candidatos.add((min(a, b), max(a, b)))
+
+    # Se verifica la similitud real de cada candidato
+    guardados = {x for par in candidatos for x in par if x not in conjuntos}
+    for bloque in _en_bloques(list(guardados)):
+        for internal_id, nombre, id_grupo in session.exec(select(Adj.internal_id, Adj.nombre, Adj.id_grupo).where(col(Adj.internal_id).in_(bloque))):
+            conjuntos[internal_id] = ngramas(clave_comparacion(nombre or ""))
+            grupo_actual[internal_id] = id_grupo
+    for a, b in candidatos:
+        if jaccard(conjuntos[a], conjuntos[b]) >= UMBRAL_SIMILITUD:
+            uf.une(a, b)
+
+    # Los grupos guardados que quedan unidos a través de un adjudicatario nuevo se fusionan
+    for internal_id, id_grupo in grupo_actual.items():
+        uf.une(internal_id, id_grupo)
+    componentes: Dict[int, Set[int]] = defaultdict(set)
+    for internal_id in list(uf.padre):
+        componentes[uf.busca(internal_id)].add(internal_id)
+
+    storage.carga_masiva(session, clean_db.BandaAdjudicatario, filas_bandas)
+    tocados = set()
+    for raiz, miembros in componentes.items():
+        grupos_previos = {grupo_actual[m] for m in miembros if m in grupo_actual} - {raiz}
+        if grupos_previos:
+            session.execute(update(Adj).where(col(Adj.id_grupo).in_(grupos_previos)).values(id_grupo=raiz))
+        nuevos_miembros = [dict(internal_id=m, id_grupo=raiz, nif=nifs.get(m)) for m in miembros if m not in grupo_actual]
+        if nuevos_miembros:
+            session.execute(update(Adj), nuevos_miembros)
+        tocados.add(raiz)
+    actualiza_similares(session, tocados)
+    session.commit()
+    logging.info("Adjudicatarios agrupados: %d nuevos en %d grupos", len(nuevos), len(tocados))
+    return len(nuevos)
+
+# Rellena nombres_similares y num_nombres_similares de los miembros de los grupos indicados
+def actualiza_similares(session: Session, grupos: Set[int]):
+    Adj = clean_db.Adjudicatario
+    filas = []
+    for bloque in _en_bloques(list(grupos)):
+        miembros: Dict[int, List[Tuple[int, str]]] = defaultdict(list)
+        for internal_id, nombre, id_grupo in session.exec(select(Adj.internal_id, Adj.nombre, Adj.id_grupo).where(col(Adj.id_grupo).in_(bloque))):
+            miembros[id_grupo].append((internal_id, nombre))
+        for lista in miembros.values():
+            for internal_id, nombre in lista:
+                otros = sorted({n for i, n in lista if i != internal_id and n != nombre})
+                filas.append(dict(internal_id=internal_id, nombres_similares="; ".join(otros) or None, num_nombres_similares=len(otros)))
+    if filas:
+        session.execute(update(Adj), filas)
@@ -6,6 +6,7 @@ def read_params():
     parser.add_argument("-l","--links", type=str, nargs='+', help="Enlaces de los perfiles de contratación, por defecto carga los perfiles del municipio Jerez de la Frontera")
     parser.add_argument("-p", "--patience", type=int, default=5, help="Paciencia del scrapper en segundos para las esperas implicitas (default=5)")
     parser.add_argument("-hd", "--headless", action="store_true", help="Activa el flag para que desaparezca la ventana de navegador durante el scrapping")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Número de órganos de contratación que se recorren en paralelo (default=1)")
 
     args = parser.parse_args()
     
@@ -47,7 +48,7 @@ crea_clean_db = 'clean_db.py'
 carga_clean_db = 'standar_upload.py'
 
 # Ejecuta el primer script
-script1 = subprocess.run(['python', scraping]+Enlaces, capture_output=True, text=True)
+script1 = subprocess.run(['python', scraping]+Enlaces+['-w', str(args.workers)], capture_output=True, text=True)
 
 # Si el primer script se ejecutó correctamente, ejecuta el segundo script
 if script1.returncode == 0:
@@ -0,0 +1,46 @@
+from typing import Dict, Optional, Tuple
+from lxml import html as lxml_html
+
+# Identificadores de las tablas de la página de detalle de un expediente
+TABLA_DETALLE = "DetalleLicitacionVIS_UOE"
+TABLA_INFORMACION = "InformacionLicitacionVIS_UOE"
+
+# Comprueba si el HTML contiene ya la ficha del expediente o necesita ejecutar JavaScript
+def contiene_detalle(page_html: str) -> bool:
+    return TABLA_DETALLE in page_html
+
+# Extrae la fecha del anuncio y la información de las tablas de detalle a partir del HTML
+def parse_expediente(page_html: str) -> Tuple[Optional[str], Dict[str, str]]:
+    doc = lxml_html.fromstring(page_html)
+    info = extract_table_info(doc, TABLA_DETALLE)
+    info.update(extract_table_info(doc, TABLA_INFORMACION, skip_first=True))
+    return extract_fecha(doc), info
+
+# Extrae la fecha del anuncio de la primera fila del historial de publicaciones
+def extract_fecha(doc) -> Optional[str]:
+    rows = doc.find_class("rowClass1")
+    if not rows:
+        return None
+    div = next(rows[0].iterdescendants("div"), None)
+    if div is None:
+        return None
+    return " ".join(div.text_content().split())
+
+# Extrae la información de una tabla específica del documento
+def extract_table_info(doc, table_id: str, skip_first: bool = False) -> Dict[str, str]:
+    info = {}
+    table = doc.get_element_by_id(table_id)
+    table_list = list(table.iterdescendants("ul"))
+    # Salta el título de la tabla
+    if skip_first:
+        table_list = table_list[1:]
+    # Itera sobre la tabla para extraer los datos y rellena el diccionario del expediente
+    for t in table_list:
+        tab_line = list(t.iterdescendants("li"))
+        if len(tab_line) >= 2:
+            key_span = next(tab_line[0].iterdescendants("span"), None)
+            answ_span = next(tab_line[1].iterdescendants("span"), None)
+            if key_span is None or answ_span is None:
+                continue
+            info[(key_span.get("title") or "").strip()] = (answ_span.get("title") or "").strip()
+    return info
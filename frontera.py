@@ -0,0 +1,135 @@
+import datetime
+import json
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from sqlmodel import SQLModel, Field, Session, select, update, delete, col
+import storage
+
+# Estados de un elemento de la frontera
+PENDIENTE = "pendiente"
+EN_CURSO = "en_curso"
+HECHO = "hecho"
+ERROR = "error"
+
+# Tipos de elemento: perfiles de contratante y cabeceras de expedientes pendientes de comprobar
+ORGANO = "organo"
+CABECERA = "cabecera"
+
+# Elemento de la frontera del rastreo. En los órganos, pagina guarda la última página de licitaciones recorrida
+class ElementoFrontera(SQLModel, table=True):
+    id: int = Field(default=None, primary_key=True)
+    tipo: str = Field(index=True)
+    organo: str = Field(index=True)
+    clave: str
+    estado: str = Field(default=PENDIENTE, index=True)
+    pagina: int = Field(default=0)
+    datos: Optional[str] = None
+    intentos: int = Field(default=0)
+    actualizado: datetime.datetime = Field(default_factory=datetime.datetime.now)
+
+# Convierte una cabecera a JSON y viceversa para guardarla en la frontera
+def _cabecera_a_json(cab: Dict[str, Any]) -> str:
+    return json.dumps(cab, default=lambda v: v.isoformat())
+
+def _cabecera_de_json(datos: str) -> Dict[str, Any]:
+    cab = json.loads(datos)
+    cab["Timetrack"] = datetime.datetime.fromisoformat(cab["Timetrack"])
+    return cab
+
+# Frontera persistente del rastreo en SQLite: si una ejecución se interrumpe, la siguiente continúa donde se quedó
+class Frontera:
+    def __init__(self, path: str, max_intentos: int = 3):
+        self.engine = storage.engine(f"sqlite:///{path}")
+        SQLModel.metadata.create_all(self.engine, tables=[ElementoFrontera.__table__])
+        self.max_intentos = max_intentos
+        self._lock = threading.Lock()
+
+    # Reanuda el rastreo anterior si quedó sin terminar o empieza uno nuevo con los enlaces indicados.
+    # Devuelve True si se reanuda
+    def inicia(self, links: List[str]) -> bool:
+        with self._lock, Session(self.engine) as db:
+            # Los elementos que estaban en curso cuando se interrumpió la ejecución vuelven a quedar pendientes
+            db.execute(update(ElementoFrontera)
+                       .where(col(ElementoFrontera.estado).in_([EN_CURSO, ERROR]), ElementoFrontera.intentos < self.max_intentos)
+                       .values(estado=PENDIENTE))
+            pendientes = db.exec(select(ElementoFrontera.id).where(ElementoFrontera.estado == PENDIENTE)).first()
+            if pendientes is not None:
+                db.commit()
+                logging.info("Se reanuda el rastreo anterior desde la frontera")
+                return True
+
+            db.execute(delete(ElementoFrontera))
+            for link in links:
+                db.add(ElementoFrontera(tipo=ORGANO, organo=link, clave=link))
+            db.commit()
+            return False
+
+    # Enlaces de los órganos que quedan por recorrer
+    def organos_pendientes(self) -> List[str]:
+        with Session(self.engine) as db:
+            statement = select(ElementoFrontera.organo).where(ElementoFrontera.tipo == ORGANO, ElementoFrontera.estado == PENDIENTE).order_by(ElementoFrontera.id)
+            return list(db.exec(statement).all())
+
+    # Reclama un órgano para recorrerlo, devuelve la última página recorrida o None si ya lo ha reclamado otro trabajador
+    def reclama_organo(self, link: str) -> Optional[int]:
+        with self._lock, Session(self.engine) as db:
+            elemento = db.exec(select(ElementoFrontera).where(ElementoFrontera.tipo == ORGANO, ElementoFrontera.organo == link,
+                                                              ElementoFrontera.estado == PENDIENTE)).first()
+            if elemento is None:
+                return None
+            elemento.estado = EN_CURSO
+            elemento.intentos += 1
+            elemento.actualizado = datetime.datetime.now()
+            pagina = elemento.pagina
+            db.add(elemento)
+            db.commit()
+            return pagina
+
+    # Guarda en una misma transacción el avance de un órgano y las cabeceras de la página recorrida
+    def guarda_pagina(self, link: str, pagina: int, cabeceras: List[Dict[str, Any]]):
+        with self._lock, Session(self.engine) as db:
+            db.execute(update(ElementoFrontera)
+                       .where(ElementoFrontera.tipo == ORGANO, ElementoFrontera.organo == link)
+                       .values(pagina=pagina, actualizado=datetime.datetime.now()))
+            for cab in cabeceras:
+                db.add(ElementoFrontera(tipo=CABECERA, organo=link, clave=cab["Nombre del expediente"], datos=_cabecera_a_json(cab)))
+            db.commit()
+
+    def _marca_organo(self, link: str, estado: str):
+        with self._lock, Session(self.engine) as db:
+            db.execute(update(ElementoFrontera)
+                       .where(ElementoFrontera.tipo == ORGANO, ElementoFrontera.organo == link)
+                       .values(estado=estado, actualizado=datetime.datetime.now()))
+            db.commit()
+
+    def completa_organo(self, link: str):
+        self._marca_organo(link, HECHO)
+
+    def falla_organo(self, link: str):
+        self._marca_organo(link, ERROR)
+
+    # Órganos ya recorridos que tienen cabeceras sin procesar
+    def organos_con_cabeceras_pendientes(self) -> List[str]:
+        with Session(self.engine) as db:
+            organos_hechos = select(ElementoFrontera.organo).where(ElementoFrontera.tipo == ORGANO, ElementoFrontera.estado == HECHO)
+            statement = (select(ElementoFrontera.organo).distinct()
+                         .where(ElementoFrontera.tipo == CABECERA, ElementoFrontera.estado == PENDIENTE,
+                                col(ElementoFrontera.organo).in_(organos_hechos)))
+            return list(db.exec(statement).all())
+
+    # Cabeceras pendientes de un órgano como pares (id, cabecera)
+    def cabeceras_pendientes(self, link: str) -> List[Tuple[int, Dict[str, Any]]]:
+        with Session(self.engine) as db:
+            statement = (select(ElementoFrontera.id, ElementoFrontera.datos)
+                         .where(ElementoFrontera.tipo == CABECERA, ElementoFrontera.organo == link, ElementoFrontera.estado == PENDIENTE)
+                         .order_by(ElementoFrontera.id))
+            return [(id_elemento, _cabecera_de_json(datos)) for id_elemento, datos in db.exec(statement).all()]
+
+    # Marca como procesadas las cabeceras indicadas
+    def completa_cabeceras(self, ids: List[int]):
+        if not ids:
+            return
+        with self._lock, Session(self.engine) as db:
+            db.execute(update(ElementoFrontera).where(col(ElementoFrontera.id).in_(ids)).values(estado=HECHO, actualizado=datetime.datetime.now()))
+            db.commit()
@@ -0,0 +1,78 @@
+import logging
+import threading
+import time
+from typing import Any, NamedTuple, Optional
+from urllib.parse import urlsplit, urlunsplit
+import requests
+from requests.adapters import HTTPAdapter
+from rate_limiter import limitador
+
+# Cabeceras de un navegador normal para que el servidor devuelva la misma página que a Chrome
+CABECERAS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "es-ES,es;q=0.9",
+}
+
+_local = threading.local()
+
+# Crea una sesión HTTP con un pool de conexiones persistentes (keep-alive)
+def crea_sesion(pool_size: int = 10) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(CABECERAS)
+    return session
+
+# Devuelve la sesión del hilo actual, creándola la primera vez
+def sesion() -> requests.Session:
+    if not hasattr(_local, "session"):
+        _local.session = crea_sesion()
+    return _local.session
+
+# Sustituye el servidor de la url por el de un espejo local (por ejemplo, servidor_local.py)
+def aplica_espejo(url: str, args: Any) -> str:
+    mirror = getattr(args, "mirror", None)
+    if not mirror:
+        return url
+    base = urlsplit(mirror)
+    partes = urlsplit(url)
+    return urlunsplit((base.scheme, base.netloc, partes.path, partes.query, partes.fragment))
+
+# Respuesta de una descarga condicional: texto es None si la página no ha cambiado (304)
+class RespuestaHtml(NamedTuple):
+    texto: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+# Descarga una página solo si ha cambiado desde la versión con el ETag o la fecha Last-Modified indicados.
+# Devuelve None si la petición falla
+def descarga_html_condicional(url: str, args: Any, etag: Optional[str] = None, last_modified: Optional[str] = None) -> Optional[RespuestaHtml]:
+    url = aplica_espejo(url, args)
+    cabeceras = {}
+    if etag:
+        cabeceras["If-None-Match"] = etag
+    if last_modified:
+        cabeceras["If-Modified-Since"] = last_modified
+    limite = limitador(url, args)
+    limite.espera()
+    inicio = time.monotonic()
+    try:
+        respuesta = sesion().get(url, headers=cabeceras, timeout=args.patience)
+        respuesta.raise_for_status()
+    except requests.RequestException as e:
+        limite.error()
+        logging.warning("Fallo en la descarga HTTP de %s: %s", url, e)
+        return None
+    limite.exito(time.monotonic() - inicio)
+
+    etag = respuesta.headers.get("ETag", etag)
+    last_modified = respuesta.headers.get("Last-Modified", last_modified)
+    if respuesta.status_code == 304:
+        return RespuestaHtml(None, etag, last_modified)
+
+    # Sin charset en la cabecera requests asume ISO-8859-1, se usa el detectado en el contenido
+    if "charset" not in respuesta.headers.get("Content-Type", "").lower():
+        respuesta.encoding = respuesta.apparent_encoding
+    return RespuestaHtml(respuesta.text, etag, last_modified)
@@ -0,0 +1,88 @@
+import logging
+from datetime import datetime
+from typing import Callable, List, Tuple
+from sqlmodel import SQLModel, Field, Session, select, func
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+# Migraciones del esquema de la base de datos limpia. Cada migración tiene un número de versión y se aplica una sola vez,
+# en orden, en su propia transacción; las versiones aplicadas se guardan en la tabla VersionEsquema.
+# Las migraciones usan SQL directo porque deben funcionar con el esquema antiguo, no con los modelos actuales.
+# clean_db.connect_db las aplica al abrir la base de datos, y también se pueden aplicar con python clean_db.py
+
+# Versión aplicada del esquema, una fila por migración
+class VersionEsquema(SQLModel, table=True):
+    __tablename__ = "VersionEsquema"
+    version: int = Field(primary_key=True)
+    descripcion: str
+    aplicada: datetime
+
+def _columnas(conn: Connection, tabla: str) -> set:
+    return {c["name"] for c in inspect(conn).get_columns(tabla)}
+
+# Claves enteras para los adjudicatarios: nombre único e indexado y Expediente.adjudicatario_id rellenado a partir
+# del nombre. Los adjudicatarios con el mismo nombre se funden en el de menor internal_id
+def _adjudicatario_id(conn: Connection):
+    inspector = inspect(conn)
+    duplicados = conn.execute(text('SELECT nombre, MIN(internal_id) FROM "Adjudicatario" WHERE nombre IS NOT NULL '
+                                   'GROUP BY nombre HAVING COUNT(*) > 1')).all()
+    for nombre, conservado in duplicados:
+        sobrantes = [fila[0] for fila in conn.execute(text('SELECT internal_id FROM "Adjudicatario" WHERE nombre = :nombre AND internal_id <> :id'),
+                                                       {"nombre": nombre, "id": conservado})]
+        for sobrante in sobrantes:
+            if "id_grupo" in _columnas(conn, "Adjudicatario"):
+                conn.execute(text('UPDATE "Adjudicatario" SET id_grupo = :conservado WHERE id_grupo = :sobrante'), {"conservado": conservado, "sobrante": sobrante})
+            if inspector.has_table("BandaAdjudicatario"):
+                conn.execute(text('DELETE FROM "BandaAdjudicatario" WHERE adjudicatario_id = :sobrante'), {"sobrante": sobrante})
+            conn.execute(text('DELETE FROM "Adjudicatario" WHERE internal_id = :sobrante'), {"sobrante": sobrante})
+    if duplicados:
+        logging.info("%d nombres de adjudicatario duplicados fundidos", len(duplicados))
+    # Mismo nombre que el índice del modelo para que crea_tablas no lo vuelva a crear
+    conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS "ix_Adjudicatario_nombre" ON "Adjudicatario" (nombre)'))
+
+    if "adjudicatario_id" not in _columnas(conn, "Expediente"):
+        conn.execute(text('ALTER TABLE "Expediente" ADD COLUMN adjudicatario_id INTEGER REFERENCES "Adjudicatario" (internal_id)'))
+    resultado = conn.execute(text('UPDATE "Expediente" SET adjudicatario_id = (SELECT a.internal_id FROM "Adjudicatario" a WHERE a.nombre = "Expediente".adjudicatario) '
+                                  'WHERE adjudicatario IS NOT NULL'))
+    logging.info("%d expedientes enlazados con su adjudicatario", resultado.rowcount)
+
+# Nombre de expediente único e indexado. De los expedientes repetidos se conserva el más reciente (mayor timetrack y,
+# a igualdad, mayor internal_id). Ninguna tabla apunta a Expediente, pero los agregados cuentan los repetidos:
+# se vacían para que la siguiente carga los reconstruya
+def _nombre_exp_unico(conn: Connection):
+    resultado = conn.execute(text('DELETE FROM "Expediente" WHERE nombre_exp IS NOT NULL AND EXISTS ('
+                                  'SELECT 1 FROM "Expediente" o WHERE o.nombre_exp = "Expediente".nombre_exp AND ('
+                                  'o.timetrack > "Expediente".timetrack OR (o.timetrack = "Expediente".timetrack AND o.internal_id > "Expediente".internal_id)))'))
+    if resultado.rowcount:
+        logging.info("%d expedientes duplicados eliminados", resultado.rowcount)
+        inspector = inspect(conn)
+        for tabla in ("TotalOrganoAdjudicatario", "TotalOrganoMes", "TotalCPV", "TotalProcedimiento"):
+            if inspector.has_table(tabla):
+                conn.execute(text(f'DELETE FROM "{tabla}"'))
+    # Mismo nombre que el índice del modelo para que crea_tablas no lo vuelva a crear
+    conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS "ix_Expediente_nombre_exp" ON "Expediente" (nombre_exp)'))
+
+# Migraciones en orden: (versión, descripción, función)
+MIGRACIONES: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "Claves enteras de adjudicatario en los expedientes y nombre de adjudicatario único", _adjudicatario_id),
+    (2, "Nombre de expediente único, conservando el expediente más reciente de cada nombre", _nombre_exp_unico),
+]
+
+def version(engine: Engine) -> int:
+    with Session(engine) as db:
+        return db.exec(select(func.max(VersionEsquema.version))).one() or 0
+
+# Aplica las migraciones pendientes. Se llama antes de crear las tablas del modelo: en una base de datos nueva
+# no hay nada que migrar y las migraciones solo se registran como aplicadas
+def migra(engine: Engine):
+    nueva = not inspect(engine).has_table("Expediente")
+    SQLModel.metadata.create_all(engine, tables=[VersionEsquema.__table__])
+    actual = version(engine)
+    for numero, descripcion, aplica in MIGRACIONES:
+        if numero <= actual:
+            continue
+        with engine.begin() as conn:
+            if not nueva:
+                logging.info("Migración %d: %s", numero, descripcion)
+                aplica(conn)
+            conn.execute(VersionEsquema.__table__.insert().values(version=numero, descripcion=descripcion, aplicada=datetime.now()))
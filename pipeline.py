@@ -0,0 +1,82 @@
+import logging
+import queue
+import threading
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+import scraping_params
+from driver_pool import DriverPool
+
+# Tipos de evento que recibe la etapa de escritura
+PAGINA = "pagina"
+ORGANO = "organo"
+EXPEDIENTE = "expediente"
+FIN_CABECERAS = "fin_cabeceras"
+
+# Etapa de descarga: toma cabeceras de la cola de detalles y envía los expedientes descargados como eventos
+def _descargador(args: Any, pool: DriverPool, detalles: queue.Queue, eventos: queue.Queue):
+    while True:
+        cab = detalles.get()
+        if cab is None:
+            break
+        try:
+            expediente = scraping_params.descarga_expediente(args, cab, pool)
+        except Exception as e:
+            logging.error("Error al abrir el expediente %s: %s", cab["Nombre del expediente"], e)
+            expediente = None
+        # También se avisa de las descargas fallidas para llevar la cuenta de las pendientes
+        eventos.put((EXPEDIENTE, (cab, expediente)))
+
+# Etapa de lectura de cabeceras: cada página se envía como evento en cuanto se lee
+def _productor(args: Any, pool: DriverPool, conocidas: Dict[str, Set[Tuple[str, str]]], eventos: queue.Queue):
+    try:
+        al_terminar_pagina = lambda link, pagina, cabeceras: eventos.put((PAGINA, cabeceras))
+        for link, _, completo in scraping_params.itera_cabeceras(args, pool, conocidas, al_terminar_pagina=al_terminar_pagina):
+            eventos.put((ORGANO, (link, completo)))
+    except Exception as e:
+        logging.error("Error en la lectura de cabeceras: %s", e)
+    finally:
+        eventos.put((FIN_CABECERAS, None))
+
+# Ejecuta el rastreo como una cadena de etapas: lectura de cabeceras -> comparación -> descarga -> escritura.
+# La comparación y la escritura se hacen en el hilo que llama, que es el único que usa la base de datos:
+#   estados: nombre -> estado de los expedientes almacenados, se actualiza con cada expediente guardado
+#   guarda: escribe un expediente descargado
+#   al_terminar_organo: recibe el enlace de cada órgano recorrido y si su paginación llegó a la última página
+def ejecuta(args: Any, pool: DriverPool, estados: Dict[str, str], guarda: Callable[[Dict[str, Any]], None],
+            conocidas: Optional[Dict[str, Set[Tuple[str, str]]]] = None,
+            al_terminar_organo: Optional[Callable[[str, bool], None]] = None):
+    # Las colas acotadas frenan a las etapas anteriores si la escritura se retrasa; la de detalles solo guarda cabeceras
+    eventos = queue.Queue(maxsize=args.queue_size)
+    detalles = queue.Queue()
+    n_descargadores = args.concurrency if args.fetch == "http" else max(1, args.workers)
+
+    hilos = [threading.Thread(target=_productor, args=(args, pool, conocidas or {}, eventos), daemon=True)]
+    hilos += [threading.Thread(target=_descargador, args=(args, pool, detalles, eventos), daemon=True) for _ in range(n_descargadores)]
+    for hilo in hilos:
+        hilo.start()
+
+    en_descarga = set()
+    cabeceras_terminadas = False
+    try:
+        while not (cabeceras_terminadas and not en_descarga):
+            tipo, dato = eventos.get()
+            if tipo == PAGINA:
+                # Comparación: solo pasan a descarga los expedientes nuevos o con cambio de estado
+                for cab in dato:
+                    nombre = cab["Nombre del expediente"]
+                    if nombre not in en_descarga and estados.get(nombre) != cab["Estado de la Licitación"]:
+                        en_descarga.add(nombre)
+                        detalles.put(cab)
+            elif tipo == EXPEDIENTE:
+                cab, expediente = dato
+                en_descarga.discard(cab["Nombre del expediente"])
+                if expediente is not None:
+                    guarda(expediente)
+                    estados[cab["Nombre del expediente"]] = cab["Estado de la Licitación"]
+            elif tipo == ORGANO:
+                if al_terminar_organo is not None:
+                    al_terminar_organo(*dato)
+            elif tipo == FIN_CABECERAS:
+                cabeceras_terminadas = True
+    finally:
+        for _ in range(n_descargadores):
+            detalles.put(None)
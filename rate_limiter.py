@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+from urllib.parse import urlsplit
+
+# Servidor de la Plataforma de Contratación del Sector Público
+PLATAFORMA = "contrataciondelestado.es"
+
+# Limitador de peticiones por servidor basado en un cubo de tokens con ritmo adaptativo:
+# sube poco a poco mientras el servidor responde bien y baja a la mitad ante errores o respuestas lentas
+class RateLimiter:
+    def __init__(self, rps: float, max_rps: Optional[float] = None, min_rps: Optional[float] = None,
+                 capacidad: float = 1.0, umbral_lento: float = 3.0):
+        self.rps = rps
+        self.max_rps = max_rps if max_rps is not None else rps
+        self.min_rps = min_rps if min_rps is not None else rps / 10
+        self.capacidad = max(1.0, capacidad)
+        self.umbral_lento = umbral_lento
+        self._incremento = rps / 10
+        self._tokens = self.capacidad
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _rellena(self):
+        ahora = time.monotonic()
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.rps)
+        self._ultimo = ahora
+
+    # Bloquea hasta que haya un token disponible para hacer una petición
+    def espera(self):
+        while True:
+            with self._lock:
+                self._rellena()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                falta = (1 - self._tokens) / self.rps
+            time.sleep(falta)
+
+    # Registra una respuesta correcta y ajusta el ritmo según lo que ha tardado
+    def exito(self, duracion: float):
+        with self._lock:
+            self._rellena()
+            if duracion > self.umbral_lento:
+                self.rps = max(self.min_rps, self.rps / 2)
+                logging.info("Respuesta lenta (%.1f s), se reduce el ritmo a %.2f peticiones/s", duracion, self.rps)
+            else:
+                self.rps = min(self.max_rps, self.rps + self._incremento)
+
+    # Registra una petición fallida y reduce el ritmo a la mitad
+    def error(self):
+        with self._lock:
+            self._rellena()
+            self.rps = max(self.min_rps, self.rps / 2)
+            logging.info("Petición fallida, se reduce el ritmo a %.2f peticiones/s", self.rps)
+
+    # Envuelve una petición: espera su turno y registra el resultado y la duración
+    @contextmanager
+    def peticion(self) -> Iterator[None]:
+        self.espera()
+        inicio = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.error()
+            raise
+        self.exito(time.monotonic() - inicio)
+
+_limitadores: Dict[str, RateLimiter] = {}
+_lock = threading.Lock()
+
+# Devuelve el limitador compartido del servidor de una url, creándolo con el presupuesto de los argumentos
+def limitador(url: str, args: Any) -> RateLimiter:
+    host = urlsplit(url).netloc or url
+    with _lock:
+        if host not in _limitadores:
+            _limitadores[host] = RateLimiter(args.rps, max_rps=args.max_rps, umbral_lento=args.patience / 2)
+        return _limitadores[host]
@@ -1,9 +1,26 @@
-from sqlmodel import SQLModel, Field, create_engine, Session, select
+from sqlmodel import SQLModel, Field, Relationship, Session, select, update, col
+from sqlalchemy import Index
+from sqlalchemy.engine import Engine
 import datetime
-from typing import List, Dict, Any, Optional
-import scraping_params
+import hashlib
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+import threading
 import time
-DATABASE_URL = "sqlite:///raw_database.db"
+from typing import List, Dict, Any, NamedTuple, Optional, Set, Tuple
+import scraping_params
+import extractor_html
+import http_fetch
+import async_crawler
+import pipeline
+from driver_pool import DriverPool
+from frontera import Frontera
+import blob_store
+import storage
+from blob_store import HtmlBlob
+DATABASE_URL = storage.RAW_URL
 
 Municipio_Jerez = [
         "https://contrataciondelestado.es/wps/poc?uri=deeplink:perfilContratante&idBp=xO%2BVWYM1HLcQK2TEfXGy%2BA%3D%3D", # Aena. Dirección del Aeropuerto de Jerez
@@ -26,6 +43,9 @@ Municipio_Jerez = [
 
 # Clase para almacenar todos los expedientes en crudo, tipo de datos SRT
 class ExpedienteRaw(SQLModel, table=True):
+    # La comparación de cabeceras busca siempre la versión reciente de cada expediente por su nombre
+    __table_args__ = (Index("ix_expedienteraw_nombre_reciente", "nombre", "reciente"),)
+
     id: int = Field(default=None, primary_key=True)
     nombre: str
     url: str
@@ -53,89 +73,364 @@ class ExpedienteRaw(SQLModel, table=True):
     Num_de_Licitadores: Optional[str] = None
     Importe_de_Adjudicacion: Optional[str] = None
     Fecha_fin_de_solicitud: Optional[str] = None
-    Html_page: Optional[bytes] = None
+    # La página HTML se guarda comprimida en el almacén de páginas; se carga solo al acceder a blob
+    hash_html: Optional[str] = Field(default=None, foreign_key="htmlblob.hash", index=True)
+    blob: Optional[HtmlBlob] = Relationship()
+    # Hash normalizado de los campos extraídos, detecta cambios en el detalle aunque no cambie el estado
+    hash_campos: Optional[str] = None
+    # Validadores HTTP de la página y fecha de la última comprobación, para la revalidación
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    revisado: Optional[datetime.datetime] = None
+
+    # HTML de la página de detalle, se lee del almacén al pedirlo
+    @property
+    def html(self) -> Optional[bytes]:
+        return self.blob.html if self.blob is not None else None
+
+# Fecha del último recorrido completo de cada perfil de contratante, para el modo incremental
+class BarridoPerfil(SQLModel, table=True):
+    link: str = Field(primary_key=True)
+    ultimo_completo: datetime.datetime = Field(default_factory=datetime.datetime.now)
+
+# Datos de la versión reciente de un expediente que se usan para detectar cambios, sin el HTML
+class CabeceraAlmacenada(NamedTuple):
+    estado: str
+    id_organo: Optional[str]
+    hash_html: Optional[str]
+
+# Abre la base de datos cruda creando las tablas y añadiendo las columnas e índices que falten en una base de datos existente
+def connect_db(url: str = DATABASE_URL) -> Engine:
+    engine = storage.engine(url)
+    # Solo las tablas de la base de datos cruda: los modelos de la base de datos limpia comparten los metadatos
+    storage.crea_tablas(engine, [HtmlBlob.__table__, ExpedienteRaw.__table__, BarridoPerfil.__table__])
+    blob_store.migra_paginas_en_linea(engine)
+    return engine
+
+# Campos extraídos de la página de detalle que forman el hash de una versión
+CAMPOS_DETALLE = ["estado", "fecha_anuncio", "organo_contratacion", "id_organo", "Objeto_del_contrato", "Financiacion_UE",
+                  "Presupuesto_base_sin_impuestos", "Valor_estimado", "Tipo_de_Contrato", "Codigo_CPV", "Lugar_de_Ejecucion",
+                  "Sistema_de_contratacion", "Procedimiento_de_contratacion", "Tipo_de_tramitacion", "Metodo_de_presentacion",
+                  "Fecha_fin_de_presentacion", "Resultado", "Adjudicatario", "Num_de_Licitadores", "Importe_de_Adjudicacion",
+                  "Fecha_fin_de_solicitud"]
+
+# Hash de los campos de detalle sin tener en cuenta espacios sobrantes, para que cambios de maquetación no cuenten como cambios
+def hash_campos(campos: Dict[str, Any]) -> str:
+    normalizados = [re.sub(r"\s+", " ", str(campos.get(c) or "")).strip() for c in CAMPOS_DETALLE]
+    return hashlib.sha256(json.dumps(normalizados, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+# Campos de ExpedienteRaw a partir del diccionario de un expediente descargado
+def campos_expediente(exp: Dict[str, Any]) -> Dict[str, Any]:
+    campos = dict(
+        nombre=exp["Nombre del expediente"],
+        url=exp["url de descarga"],
+        estado=exp["Estado de la Licitación"],
+        timetrack=exp["Timetrack"],
+        fecha_anuncio=exp["fecha_anuncio"],
+        organo_contratacion = exp.get("Órgano de Contratación"),
+        id_organo = exp.get("ID del Órgano de Contratación"),
+        Objeto_del_contrato=exp.get("Objeto del contrato"),
+        Financiacion_UE=exp.get("Financiación UE"),
+        Presupuesto_base_sin_impuestos=exp.get("Presupuesto base de licitación sin impuestos"),
+        Valor_estimado=exp.get("Valor estimado del contrato:"),
+        Tipo_de_Contrato=exp.get("Tipo de Contrato:"),
+        Codigo_CPV=exp.get("Código CPV"),
+        Lugar_de_Ejecucion=exp.get("Lugar de Ejecución"),
+        Sistema_de_contratacion=exp.get("Sistema de contratación"),
+        Procedimiento_de_contratacion=exp.get("Procedimiento de contratación"),
+        Tipo_de_tramitacion=exp.get("Tipo de tramitación"),
+        Metodo_de_presentacion=exp.get("Método de presentación de la oferta"),
+        Fecha_fin_de_presentacion=exp.get("Fecha fin de presentación de oferta"),
+        Resultado=exp.get("Resultado"),
+        Adjudicatario=exp.get("Adjudicatario"),
+        Num_de_Licitadores=exp.get("Nº de Licitadores Presentados"),
+        Importe_de_Adjudicacion=exp.get("Importe de Adjudicación"),
+        Fecha_fin_de_solicitud=exp.get("Fecha fin de solicitud"),
+        hash_html=blob_store.hash_html(exp.get("Página HTML")),
+        etag=exp.get("ETag"),
+        last_modified=exp.get("Last-Modified"),
+        revisado=exp["Timetrack"]
+    )
+    campos["hash_campos"] = hash_campos(campos)
+    return campos
 
 #Guarda nuevos expedientes en la base de datos.
 def save_expedientes(db: Session, expedientes: List[Dict[str, Any]]):
+    blob_store.guarda_paginas(db, paginas_expedientes(expedientes))
     for exp in expedientes:
-        expediente = ExpedienteRaw(
-            nombre=exp["Nombre del expediente"],
-            url=exp["url de descarga"],
-            estado=exp["Estado de la Licitación"],
-            timetrack=exp["Timetrack"],
-            fecha_anuncio=exp["fecha_anuncio"],
-            reciente=True,
-            organo_contratacion = exp.get("Órgano de Contratación"),
-            id_organo = exp.get("ID del Órgano de Contratación"),
-            Objeto_del_contrato=exp.get("Objeto del contrato"),
-            Financiacion_UE=exp.get("Financiación UE"),
-            Presupuesto_base_sin_impuestos=exp.get("Presupuesto base de licitación sin impuestos"),
-            Valor_estimado=exp.get("Valor estimado del contrato:"),
-            Tipo_de_Contrato=exp.get("Tipo de Contrato:"),
-            Codigo_CPV=exp.get("Código CPV"),
-            Lugar_de_Ejecucion=exp.get("Lugar de Ejecución"),
-            Sistema_de_contratacion=exp.get("Sistema de contratación"),
-            Procedimiento_de_contratacion=exp.get("Procedimiento de contratación"),
-            Tipo_de_tramitacion=exp.get("Tipo de tramitación"),
-            Metodo_de_presentacion=exp.get("Método de presentación de la oferta"),
-            Fecha_fin_de_presentacion=exp.get("Fecha fin de presentación de oferta"),
-            Resultado=exp.get("Resultado"),
-            Adjudicatario=exp.get("Adjudicatario"),
-            Num_de_Licitadores=exp.get("Nº de Licitadores Presentados"),
-            Importe_de_Adjudicacion=exp.get("Importe de Adjudicación"),
-            Fecha_fin_de_solicitud=exp.get("Fecha fin de solicitud"),
-            Html_page=exp.get("Página HTML")
-        )
+        expediente = ExpedienteRaw(reciente=True, **campos_expediente(exp))
         db.add(expediente)  
     db.commit()  
 
-# Marca el expediente con el mismo nombre como antiguo (reciente = False)
-def mark_as_old(db: Session, nombre: str):
-    statement = select(ExpedienteRaw).where(ExpedienteRaw.nombre == nombre, ExpedienteRaw.reciente == True)
-    results = db.exec(statement)
-    for expediente in results:
-        expediente.reciente = False
-    db.commit()  
+# Páginas HTML de los expedientes por su hash
+def paginas_expedientes(expedientes: List[Dict[str, Any]]) -> Dict[str, bytes]:
+    return {blob_store.hash_html(exp["Página HTML"]): exp["Página HTML"] for exp in expedientes if exp.get("Página HTML") is not None}
+
+# Escritor por lotes de nuevas versiones de expedientes. Cada lote se escribe en una única transacción: las páginas nuevas
+# en el almacén, un UPDATE que retira las versiones anteriores de todos los nombres del lote y una inserción masiva de las nuevas.
+# El lote se escribe al llegar a tam_lote expedientes o cuando el más antiguo lleva más de intervalo segundos esperando,
+# aunque no lleguen más expedientes: un hilo vigila el plazo. El escritor usa su propia sesión sobre el motor de db,
+# así que quien lo crea puede seguir usando db mientras tanto
+class EscritorExpedientes:
+    def __init__(self, db: Session, indice: Optional[Dict[str, CabeceraAlmacenada]] = None,
+                 tam_lote: int = 50, intervalo: float = 5.0):
+        self.db = Session(db.get_bind())
+        self.indice = indice
+        self.tam_lote = max(1, tam_lote)
+        self.intervalo = intervalo
+        self._pendientes: List[Dict[str, Any]] = []
+        self._paginas: Dict[str, bytes] = {}
+        self._inicio_lote = None
+        self._lock = threading.Lock()
+        self._cerrado = threading.Event()
+        self._vigilante = threading.Thread(target=self._vigila, daemon=True)
+        self._vigilante.start()
+
+    # Añade un expediente al lote
+    def añade(self, expediente: Dict[str, Any]):
+        campos = campos_expediente(expediente)
+        with self._lock:
+            self._pendientes.append(campos)
+            self._paginas.update(paginas_expedientes([expediente]))
+            if self.indice is not None:
+                self.indice[campos["nombre"]] = CabeceraAlmacenada(campos["estado"], campos["id_organo"], campos["hash_html"])
+            if self._inicio_lote is None:
+                self._inicio_lote = time.monotonic()
+            if len(self._pendientes) >= self.tam_lote or self._vencido():
+                self._escribe()
+
+    def añade_lote(self, expedientes: List[Dict[str, Any]]):
+        for expediente in expedientes:
+            self.añade(expediente)
+
+    # Escribe el lote pendiente
+    def escribe(self):
+        with self._lock:
+            self._escribe()
+
+    def _vencido(self) -> bool:
+        return self._inicio_lote is not None and time.monotonic() - self._inicio_lote >= self.intervalo
+
+    # Hilo vigilante: escribe el lote cuando vence su plazo. Si falla, los expedientes siguen pendientes
+    # y el error se vuelve a producir en el siguiente añade o escribe del hilo que usa el escritor
+    def _vigila(self):
+        while True:
+            with self._lock:
+                espera = max(self.intervalo, 0.1) if self._inicio_lote is None else max(0.0, self._inicio_lote + self.intervalo - time.monotonic())
+            if self._cerrado.wait(espera):
+                return
+            with self._lock:
+                if self._vencido():
+                    try:
+                        self._escribe()
+                    except Exception as e:
+                        logging.error("No se pudo escribir el lote de expedientes: %s", e)
+                        self._inicio_lote = time.monotonic()
+
+    def _escribe(self):
+        if not self._pendientes:
+            return
+        # Si un nombre se repite en el lote, solo su última versión queda como reciente
+        ultima = {campos["nombre"]: i for i, campos in enumerate(self._pendientes)}
+        filas = [dict(campos, reciente=ultima[campos["nombre"]] == i) for i, campos in enumerate(self._pendientes)]
+        try:
+            blob_store.guarda_paginas(self.db, self._paginas)
+            self.db.execute(update(ExpedienteRaw)
+                            .where(col(ExpedienteRaw.nombre).in_(list(ultima)), ExpedienteRaw.reciente == True)
+                            .values(reciente=False))
+            storage.carga_masiva(self.db, ExpedienteRaw, filas)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        logging.info("Guardados %d expedientes", len(filas))
+        self._pendientes = []
+        self._paginas = {}
+        self._inicio_lote = None
+
+    # Detiene el hilo vigilante, escribe lo pendiente y cierra la sesión
+    def cierra(self):
+        self._cerrado.set()
+        self._vigilante.join()
+        try:
+            self.escribe()
+        finally:
+            self.db.close()
+
+    def __enter__(self) -> "EscritorExpedientes":
+        return self
 
+    def __exit__(self, exc_type, exc, tb):
+        self.cierra()
 
 #Verifica y actualiza la base de datos con nuevas cabeceras y descarga los datos completos de expedientes desactualizados
-def check_and_update_db(args: Any, db: Session):    
-    cabeceras_por_organo = scraping_params.collect_cabeceras(args)  # Recolecta cabeceras
-    for org in cabeceras_por_organo:
-        link = org[0]
-        new_cabeceras = org[1]
-
-        statement = select(ExpedienteRaw).where(ExpedienteRaw.reciente == True)
-        stored_cabeceras = db.exec(statement).all()
-        stored_dict = {exp.nombre: exp for exp in stored_cabeceras}
-
-        non_updated_cabeceras = []
-        for cab in new_cabeceras:
-            nombre = cab["Nombre del expediente"]
-            estado = cab["Estado de la Licitación"]
-            timetrack = cab["Timetrack"]
-            
-            if nombre in stored_dict:
-                stored_estado = stored_dict[nombre].estado
-                if stored_estado != estado:
-                    mark_as_old(db, nombre)  # Marca como antiguos los expedientes previos
-                    non_updated_cabeceras.append(cab)  # Añade cabeceras no actualizadas a la lista
+def check_and_update_db(args: Any, db: Session, pool: Optional[DriverPool] = None):    
+    # Un único pool de navegadores para recopilar cabeceras y descargar expedientes
+    pool_propio = pool is None
+    if pool_propio:
+        # En modo --stream la descarga de expedientes necesita navegadores a la vez que la lectura de cabeceras
+        pool = DriverPool(args, size=2 * args.workers if args.stream else None)
+    try:
+        if args.stream:
+            _check_and_update_db_stream(args, db, pool)
+        else:
+            _check_and_update_db(args, db, pool)
+        if args.revalidate:
+            revalida_expedientes(args, db)
+    finally:
+        if pool_propio:
+            pool.cierra()
+
+# Cabeceras (nombre, estado) ya almacenadas para los perfiles que pueden recorrerse en modo incremental.
+# Los perfiles sin un recorrido completo en los últimos --full-sweep-days días no aparecen y se recorren enteros
+def cabeceras_conocidas(args: Any, db: Session) -> Dict[str, Set[Tuple[str, str]]]:
+    if not args.incremental:
+        return {}
+    limite = datetime.datetime.now() - datetime.timedelta(days=args.full_sweep_days)
+    barridos = {b.link: b.ultimo_completo for b in db.exec(select(BarridoPerfil)).all()}
+    links = [link for link in args.links if link in barridos and barridos[link] > limite]
+    if not links:
+        return {}
+
+    statement = select(ExpedienteRaw.nombre, ExpedienteRaw.estado).where(ExpedienteRaw.reciente == True)
+    conocidas = {(nombre, estado) for nombre, estado in db.exec(statement).all()}
+    return {link: conocidas for link in links}
+
+# Anota que un perfil se ha recorrido completo
+def registra_barrido(db: Session, link: str):
+    db.merge(BarridoPerfil(link=link, ultimo_completo=datetime.datetime.now()))
+    db.commit()
+
+# Índice nombre -> cabecera de las versiones recientes almacenadas. Se carga una sola vez por ejecución y sin la columna del HTML
+def indice_cabeceras(db: Session) -> Dict[str, CabeceraAlmacenada]:
+    statement = select(ExpedienteRaw.nombre, ExpedienteRaw.estado, ExpedienteRaw.id_organo, ExpedienteRaw.hash_html).where(ExpedienteRaw.reciente == True)
+    return {nombre: CabeceraAlmacenada(estado, id_organo, hash_html) for nombre, estado, id_organo, hash_html in db.exec(statement).all()}
+
+# Estado de los expedientes almacenados, sin cargar el resto de columnas
+def estados_almacenados(db: Session) -> Dict[str, str]:
+    return {nombre: cabecera.estado for nombre, cabecera in indice_cabeceras(db).items()}
+
+# Rastreo en cadena: las cabeceras se comparan según se lee cada página y los expedientes se descargan y se guardan a la vez que se pagina
+def _check_and_update_db_stream(args: Any, db: Session, pool: DriverPool):
+    conocidas = cabeceras_conocidas(args, db)
+
+    # Solo cuenta como barrido completo si la paginación llegó al final
+    def al_terminar_organo(link: str, completo: bool):
+        if completo and link not in conocidas:
+            registra_barrido(db, link)
+
+    with EscritorExpedientes(db, tam_lote=args.batch_size, intervalo=args.flush_interval) as escritor:
+        pipeline.ejecuta(args, pool, estados_almacenados(db), escritor.añade, conocidas, al_terminar_organo)
+
+def _check_and_update_db(args: Any, db: Session, pool: DriverPool):
+    conocidas = cabeceras_conocidas(args, db)
+    indice = indice_cabeceras(db)
+    frontera = Frontera(args.frontier) if args.frontier else None
+    with EscritorExpedientes(db, indice, tam_lote=args.batch_size, intervalo=args.flush_interval) as escritor:
+        if frontera is not None:
+            frontera.inicia(args.links)
+            # Cabeceras que quedaron sin procesar en una ejecución interrumpida de órganos que ya se habían recorrido
+            for link in frontera.organos_con_cabeceras_pendientes():
+                procesa_cabeceras_frontera(args, pool, escritor, frontera, link)
+
+        # Recolecta las cabeceras y las procesa a medida que cada órgano termina
+        for link, new_cabeceras, completo in scraping_params.itera_cabeceras(args, pool, conocidas, frontera):
+
+            if frontera is not None:
+                procesa_cabeceras_frontera(args, pool, escritor, frontera, link)
             else:
-                non_updated_cabeceras.append(cab)  # Añade nuevas cabeceras a la lista
+                procesa_cabeceras(args, pool, escritor, new_cabeceras)
 
-        if non_updated_cabeceras:
-            driver = scraping_params.abrir_navegador(link, args)  # Abre el navegador para recopilar expedientes
+            # Un recorrido cortado no cuenta como barrido completo: el siguiente rastreo vuelve a recorrer el perfil entero
+            if completo and link not in conocidas:
+                registra_barrido(db, link)
+
+# Procesa las cabeceras pendientes de un órgano en la frontera y las marca como hechas
+def procesa_cabeceras_frontera(args: Any, pool: DriverPool, escritor: EscritorExpedientes, frontera: Frontera, link: str):
+    pendientes = frontera.cabeceras_pendientes(link)
+    procesa_cabeceras(args, pool, escritor, [cab for _, cab in pendientes])
+    # Las cabeceras solo se dan por hechas cuando sus expedientes están escritos
+    escritor.escribe()
+    frontera.completa_cabeceras([id_elemento for id_elemento, _ in pendientes])
+
+# Compara las cabeceras de un órgano con la base de datos y descarga los expedientes nuevos o con cambios de estado.
+# Las versiones anteriores se retiran al escribir las nuevas
+def procesa_cabeceras(args: Any, pool: DriverPool, escritor: EscritorExpedientes, new_cabeceras: List[Dict[str, Any]]):
+    indice = escritor.indice
+    non_updated_cabeceras = []
+    for cab in new_cabeceras:
+        nombre = cab["Nombre del expediente"]
+        estado = cab["Estado de la Licitación"]
+        
+        if nombre in indice:
+            stored_estado = indice[nombre].estado
+            if stored_estado != estado:
+                non_updated_cabeceras.append(cab)  # Añade cabeceras no actualizadas a la lista
+        else:
+            non_updated_cabeceras.append(cab)  # Añade nuevas cabeceras a la lista
+
+    # En modo http los expedientes se descargan de forma concurrente y solo los que necesitan JavaScript o fallan pasan al navegador.
+    # El escritor agrupa los expedientes en lotes de --batch-size
+    solo_navegador = args.fetch == "http"
+    if solo_navegador:
+        non_updated_cabeceras = async_crawler.descarga_expedientes(args, non_updated_cabeceras, escritor.añade)
+
+    if non_updated_cabeceras:
+        # Reutiliza un navegador del pool para recopilar expedientes
+        with pool.navegador() as driver:
             # Descarga todos los datos del expediente para cada cabecera no actualizada
             for cab in non_updated_cabeceras:
-                time.sleep(1)
-                exp_data = scraping_params.recopila_expedientes(driver, args, [cab])
-                save_expedientes(db, exp_data)  # Guarda los datos del expediente en la base de datos
-            driver.quit()
+                exp_data = scraping_params.recopila_expedientes(driver, args, [cab], solo_navegador)
+                escritor.añade_lote(exp_data)  # Guarda los datos del expediente en la base de datos
+
+
+# Comprueba de nuevo las páginas de detalle de los expedientes que llevan más de --revalidate-days días sin revisar,
+# aunque su estado no haya cambiado. Se usan peticiones HTTP condicionales con los validadores guardados y
+# solo se escribe una versión nueva si cambia el hash de los campos extraídos
+def revalida_expedientes(args: Any, db: Session):
+    limite = datetime.datetime.now() - datetime.timedelta(days=args.revalidate_days)
+    statement = select(ExpedienteRaw).where(ExpedienteRaw.reciente == True,
+                                            (ExpedienteRaw.revisado == None) | (ExpedienteRaw.revisado < limite))
+    # Se copian los valores porque cada commit del escritor caduca los objetos de la sesión
+    vencidos = [exp.model_dump() for exp in db.exec(statement).all()]
+    if not vencidos:
+        return
+    logging.info("Revalidando %d expedientes", len(vencidos))
+
+    sin_cambios = []
+    nuevas = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor, \
+            EscritorExpedientes(db, tam_lote=args.batch_size, intervalo=args.flush_interval) as escritor:
+        futuros = {executor.submit(http_fetch.descarga_html_condicional, exp["url"], args, exp["etag"], exp["last_modified"]): exp for exp in vencidos}
+        for futuro in as_completed(futuros):
+            almacenado = futuros[futuro]
+            respuesta = futuro.result()
+            # Las páginas que fallan o necesitan el navegador se vuelven a intentar en la siguiente revalidación
+            if respuesta is None or (respuesta.texto is not None and not extractor_html.contiene_detalle(respuesta.texto)):
+                continue
+            revision = dict(id=almacenado["id"], revisado=datetime.datetime.now(), etag=respuesta.etag, last_modified=respuesta.last_modified)
+            if respuesta.texto is None:
+                sin_cambios.append(revision)
+                continue
+
+            cab = {"Nombre del expediente": almacenado["nombre"], "url de descarga": almacenado["url"]}
+            expediente = scraping_params.expediente_desde_html(cab, respuesta.texto, respuesta.etag, respuesta.last_modified)
+            expediente.setdefault("Estado de la Licitación", almacenado["estado"])
+            hash_almacenado = almacenado["hash_campos"] or hash_campos(almacenado)
+            if campos_expediente(expediente)["hash_campos"] == hash_almacenado:
+                sin_cambios.append(revision)
+            else:
+                escritor.añade(expediente)
+                nuevas += 1
+
+    if sin_cambios:
+        db.execute(update(ExpedienteRaw), sin_cambios)
+        db.commit()
+    logging.info("Revalidación terminada: %d expedientes sin cambios, %d versiones nuevas", len(sin_cambios), nuevas)
 
 
 if __name__ == "__main__":
-    engine = create_engine(DATABASE_URL)
-    SQLModel.metadata.create_all(engine)
+    engine = connect_db(DATABASE_URL)
     args = scraping_params.read_params()  # Lee los argumentos de entrada
     if not args.links:
         args.links = Municipio_Jerez
@@ -0,0 +1,79 @@
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List
+from sqlmodel import Session, select, update, func
+import extractor_html
+import raw_db
+from raw_db import ExpedienteRaw
+from blob_store import HtmlBlob, descomprime
+import storage
+
+# Reextrae los campos de la base de datos cruda a partir del HTML guardado, sin acceder a la red.
+# Se usa tras corregir o añadir un campo en raw_db.campos_expediente
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Campos que no salen de la página de detalle y se conservan tal y como se descargaron
+CAMPOS_FIJOS = {"nombre", "url", "timetrack", "hash_html", "etag", "last_modified", "revisado"}
+
+def read_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--database", type=str, default=raw_db.DATABASE_URL, help=f"URL de la base de datos cruda (default={raw_db.DATABASE_URL})")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Procesos que reextraen en paralelo (default=número de núcleos)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Número de ids de cada bloque de trabajo (default=500)")
+
+    args = parser.parse_args()
+
+    return args
+
+# Reextrae los campos de las filas con id en [desde, hasta) y devuelve los valores a actualizar con su id
+def reparsea_bloque(database: str, desde: int, hasta: int) -> List[Dict[str, Any]]:
+    # Motor propio del proceso: las conexiones del pool del proceso padre no se pueden compartir
+    engine = storage.crea_engine(database)
+    filas = []
+    with Session(engine) as db:
+        statement = (select(ExpedienteRaw.id, ExpedienteRaw.nombre, ExpedienteRaw.url, ExpedienteRaw.timetrack, ExpedienteRaw.estado, HtmlBlob.codec, HtmlBlob.datos)
+                     .join(HtmlBlob, HtmlBlob.hash == ExpedienteRaw.hash_html)
+                     .where(ExpedienteRaw.id >= desde, ExpedienteRaw.id < hasta))
+        for id_exp, nombre, url, timetrack, estado, codec, datos in db.exec(statement):
+            try:
+                date, info = extractor_html.parse_expediente(descomprime(codec, datos).decode("utf-8"))
+            except Exception as e:
+                logging.error("No se pudo reextraer el expediente %s (id=%d): %s", nombre, id_exp, e)
+                continue
+            exp = {"Nombre del expediente": nombre, "url de descarga": url, "Timetrack": timetrack, "fecha_anuncio": date}
+            exp.update(info)
+            # Si la página no trae el estado se mantiene el almacenado, antes de calcular hash_campos para que coincida con la fila
+            if exp.get("Estado de la Licitación") is None:
+                exp["Estado de la Licitación"] = estado
+            campos = {k: v for k, v in raw_db.campos_expediente(exp).items() if k not in CAMPOS_FIJOS}
+            campos["id"] = id_exp
+            filas.append(campos)
+    engine.dispose()
+    return filas
+
+# Reextrae toda la base de datos en bloques de ids repartidos entre procesos y actualiza cada bloque en bloque
+def reparsea(database: str, workers: int|None = None, chunk_size: int = 500) -> int:
+    engine = raw_db.connect_db(database)
+    with Session(engine) as db:
+        id_min, id_max = db.exec(select(func.min(ExpedienteRaw.id), func.max(ExpedienteRaw.id))).one()
+    if id_min is None:
+        return 0
+
+    bloques = [(desde, min(desde + chunk_size, id_max + 1)) for desde in range(id_min, id_max + 1, chunk_size)]
+    actualizados = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor, Session(engine) as db:
+        futuros = [executor.submit(reparsea_bloque, database, desde, hasta) for desde, hasta in bloques]
+        for futuro in as_completed(futuros):
+            filas = futuro.result()
+            if filas:
+                db.execute(update(ExpedienteRaw), filas)
+                db.commit()
+                actualizados += len(filas)
+            logging.info("%d expedientes reextraídos", actualizados)
+    return actualizados
+
+if __name__ == "__main__":
+    args = read_params()
+    reparsea(args.database, args.workers, args.chunk_size)
@@ -1,15 +1,17 @@
-import time
 import datetime
 import argparse
 import logging
-import random
-from typing import List, Dict, Any
-from selenium import webdriver
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Iterator, Optional, Set, Tuple, Callable
 from selenium.webdriver.remote.webdriver import WebDriver
-from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from driver_pool import DriverPool, crea_driver, registra_pagina
+import extractor_html
+from frontera import Frontera
+import http_fetch
+from rate_limiter import PLATAFORMA, limitador
 
 # Formato de los mensajes
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,43 +22,87 @@ def read_params():
     parser.add_argument("-l","--links", type=str, nargs='+', help="Enlaces del perfil del contratante")
     parser.add_argument("-p", "--patience", type=int, default=5, help="Paciencia del scrapper en segundos (default=5)")
     parser.add_argument("-hd", "--headless", action="store_true", help="Activa el flag para que desaparezca la ventana de navegador durante el scrapping")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Número de órganos que se recorren en paralelo, cada uno con su navegador headless (default=1)")
+    parser.add_argument("-r", "--recycle", type=int, default=200, help="Número de páginas tras las que se cierra y se vuelve a abrir un navegador del pool (default=200)")
+    parser.add_argument("-f", "--fetch", choices=["selenium", "http"], default="selenium", help="Modo de descarga de los expedientes: 'http' descarga el HTML directamente y solo usa el navegador si la página necesita JavaScript (default=selenium)")
+    parser.add_argument("--mirror", type=str, default=None, help="Servidor que sustituye a la plataforma en las descargas HTTP, por ejemplo http://localhost:8000 con servidor_local.py")
+    parser.add_argument("--rps", type=float, default=1.0, help="Peticiones por segundo iniciales a cada servidor, el ritmo se adapta a sus respuestas (default=1.0)")
+    parser.add_argument("--max-rps", type=float, default=4.0, help="Máximo de peticiones por segundo a cada servidor (default=4.0)")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Descargas HTTP de expedientes simultáneas en modo http (default=8)")
+    parser.add_argument("--retries", type=int, default=3, help="Reintentos de cada descarga HTTP fallida (default=3)")
+    parser.add_argument("--backoff", type=float, default=1.0, help="Espera base en segundos antes de reintentar, se duplica en cada intento (default=1.0)")
+    parser.add_argument("-i", "--incremental", action="store_true", help="Deja de paginar un perfil cuando las últimas páginas ya están en la base de datos")
+    parser.add_argument("--stop-after", type=int, default=3, help="Páginas seguidas sin cambios tras las que se detiene la paginación en modo incremental (default=3)")
+    parser.add_argument("--full-sweep-days", type=int, default=7, help="Días tras los que se vuelve a recorrer un perfil completo en modo incremental (default=7)")
+    parser.add_argument("--frontier", type=str, default=None, help="Fichero SQLite con la frontera del rastreo; si la ejecución anterior se interrumpió, se reanuda donde se quedó")
+    parser.add_argument("-s", "--stream", action="store_true", help="Procesa las cabeceras según se leen cada página y descarga los expedientes a la vez que se pagina (no compatible con --frontier)")
+    parser.add_argument("--queue-size", type=int, default=100, help="Tamaño máximo de las colas entre etapas en modo --stream (default=100)")
+    parser.add_argument("--batch-size", type=int, default=50, help="Expedientes que se escriben juntos en una transacción (default=50)")
+    parser.add_argument("--flush-interval", type=float, default=5.0, help="Segundos máximos que un expediente descargado espera a ser escrito (default=5.0)")
+    parser.add_argument("--revalidate", action="store_true", help="Tras el rastreo, comprueba por HTTP si han cambiado los detalles de los expedientes no revisados en --revalidate-days días")
+    parser.add_argument("--revalidate-days", type=float, default=7.0, help="Días tras los que se vuelve a comprobar el detalle de un expediente con --revalidate (default=7)")
 
     args = parser.parse_args()
+    if args.stream and args.frontier:
+        parser.error("--stream no es compatible con --frontier")
     
     return args
 
 # Abre la conexión con el navegador y navega a una url concreta
 def abrir_navegador(link: str, args: Any) -> WebDriver:
-    options = Options()
-    if args.headless:
-        options.add_argument("--headless=new")
-
-    driver = webdriver.Chrome(options=options)
-    driver.get(link)
-    driver.implicitly_wait(args.patience)
+    driver = crea_driver(args)
+    _abre_perfil(driver, link, args)
 
     return driver
 
-# Recolecta todas las cabeceras de licitaciones de un perfil de contratante
-def recopila_cabeceras(driver: WebDriver, args: Any) -> List[Dict[str, Any]]:
+# Pasa a la siguiente página de licitaciones y espera a que se sustituya la tabla de la página anterior
+def _siguiente_pagina(driver: WebDriver, args: Any, referencia: Any):
+    next_button = driver.find_element(By.ID, "viewns_Z7_AVEQAI930GRPE02BR764FO30G0_:form1:siguienteLink")
+    with limitador(PLATAFORMA, args).peticion():
+        next_button.click()
+        WebDriverWait(driver, args.patience).until(EC.staleness_of(referencia))
+    registra_pagina(driver)
+
+# Error que interrumpe la paginación de un perfil antes de la última página. Lleva las cabeceras leídas hasta entonces
+class RecorridoIncompleto(Exception):
+    def __init__(self, mensaje: str, cabeceras: List[Dict[str, Any]]):
+        super().__init__(mensaje)
+        self.cabeceras = cabeceras
+
+# Recolecta todas las cabeceras de licitaciones de un perfil de contratante.
+# Si se indican las cabeceras conocidas (nombre, estado) la paginación se detiene tras --stop-after páginas seguidas sin cambios.
+# pagina_inicial permite continuar un recorrido interrumpido y al_terminar_pagina recibe el número de páginas recorridas y las cabeceras de cada página.
+# Si la paginación se corta antes de la última página lanza RecorridoIncompleto
+def recopila_cabeceras(driver: WebDriver, args: Any, conocidas: Optional[Set[Tuple[str, str]]] = None, pagina_inicial: int = 0,
+                       al_terminar_pagina: Optional[Callable[[int, List[Dict[str, Any]]], None]] = None) -> List[Dict[str, Any]]:
     lista_cabeceras = []
+    paginas_sin_cambios = 0
     try:
         # Pestaña de licitaciones
         licitaciones_tab = WebDriverWait(driver, args.patience).until(
             EC.element_to_be_clickable((By.ID, "viewns_Z7_AVEQAI930GRPE02BR764FO30G0_:perfilComp:linkPrepLic"))
         )
-        licitaciones_tab.click()
+        with limitador(PLATAFORMA, args).peticion():
+            licitaciones_tab.click()
         # Obtiene el número de páginas
         n_pags = int(WebDriverWait(driver, args.patience).until(
             EC.presence_of_element_located((By.ID, "viewns_Z7_AVEQAI930GRPE02BR764FO30G0_:form1:textTotalPaginaasdasd"))
         ).text)
     except Exception as e:
-        logging.error("No se pudo cargar la página de licitaciones: %s", e)
-        return lista_cabeceras
+        raise RecorridoIncompleto(f"No se pudo cargar la página de licitaciones: {e}", lista_cabeceras)
+
+    # Al continuar un recorrido interrumpido avanza hasta la primera página sin recorrer
+    try:
+        for _ in range(pagina_inicial):
+            referencia = WebDriverWait(driver, args.patience).until(
+                EC.presence_of_element_located((By.CLASS_NAME, "tdExpediente"))
+            )
+            _siguiente_pagina(driver, args, referencia)
+    except Exception as e:
+        raise RecorridoIncompleto(f"No se pudo avanzar hasta la página {pagina_inicial + 1}: {e}", lista_cabeceras)
 
     # Itera sobre las páginas de licitaciones y recopila información de las cabeceras
-    for i in range(n_pags):
-        time.sleep(0.2)
+    for i in range(pagina_inicial, n_pags):
         try:
             # Busca los nombres de expedientes
             exp_tab = WebDriverWait(driver, args.patience).until(
@@ -67,119 +113,237 @@ def recopila_cabeceras(driver: WebDriver, args: Any) -> List[Dict[str, Any]]:
                 EC.presence_of_all_elements_located((By.CLASS_NAME, "tdEstado"))
             )
         except Exception as e:
-            logging.error("No se pudieron seleccionar los nombres de expediente: %s", e)
-            break
+            raise RecorridoIncompleto(f"No se pudieron seleccionar los nombres de expediente de la página {i + 1}: {e}", lista_cabeceras)
 
         # Recopila la información de cada expediente de la página almacenaldola en un diccionario que se añade a la lista de cabeceras
+        cabeceras_pagina = []
         for e, estado in zip(exp_tab, estado_tab):
             try:
                 elements = e.find_elements(By.TAG_NAME, 'a')
                 exp_name = elements[0].text
                 exp_link = elements[1].get_attribute('href')
                 timetrack = datetime.datetime.now()
-                lista_cabeceras.append({
+                cabeceras_pagina.append({
                     "Nombre del expediente": exp_name,
                     "url de descarga": exp_link,
                     "Estado de la Licitación": estado.text,
                     "Timetrack": timetrack})
             except Exception as e:
                 logging.error("Error al extraer datos del expediente: %s", e)
+        lista_cabeceras.extend(cabeceras_pagina)
+        if al_terminar_pagina:
+            al_terminar_pagina(i + 1, cabeceras_pagina)
+
+        # Modo incremental: las páginas más antiguas ya están en la base de datos
+        if conocidas is not None:
+            if cabeceras_pagina and all((c["Nombre del expediente"], c["Estado de la Licitación"]) in conocidas for c in cabeceras_pagina):
+                paginas_sin_cambios += 1
+            else:
+                paginas_sin_cambios = 0
+            if paginas_sin_cambios >= args.stop_after:
+                logging.info("Sin cambios en las últimas %d páginas, se detiene la paginación en la página %d de %d", paginas_sin_cambios, i+1, n_pags)
+                break
 
         # Click en el botón para la siguiente página
-        if i <= n_pags-1:
+        if i < n_pags-1:
             try:
-                next_button = driver.find_element(By.ID, "viewns_Z7_AVEQAI930GRPE02BR764FO30G0_:form1:siguienteLink")
-                next_button.click()
-                time.sleep(1)
+                # Espera a que se sustituya la tabla de la página anterior en lugar de hacer una pausa fija
+                _siguiente_pagina(driver, args, exp_tab[0])
             except Exception as e:
-                #logging.info("Última página alcanzada o no se puede hacer clic en 'siguiente': %s", e)
-                break
+                raise RecorridoIncompleto(f"No se pudo pasar a la página {i + 2} de {n_pags}: {e}", lista_cabeceras)
 
     return lista_cabeceras
 
-# Extrae la información completa de los expedientes
-def recopila_expedientes(driver: WebDriver, args: Any, lista_cabeceras: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    time.sleep(random.randrange(1,5))
+# Construye el expediente a partir del HTML de su página de detalle, extrayendo todos los campos en una sola pasada
+# etag y last_modified son los validadores HTTP de la página, para poder revalidarla más tarde con una petición condicional
+def expediente_desde_html(cab: Dict[str, Any], file_content: str, etag: Optional[str] = None, last_modified: Optional[str] = None) -> Dict[str, Any]:
+    date, info = extractor_html.parse_expediente(file_content)
+    expediente_info = {
+        "url de descarga": cab["url de descarga"],
+        "Timetrack": datetime.datetime.now(),
+        "Nombre del expediente": cab["Nombre del expediente"],
+        "Página HTML": bytearray(file_content,'utf-8'),
+        "fecha_anuncio": date,
+        "ETag": etag,
+        "Last-Modified": last_modified
+    }
+    expediente_info.update(info)
+    return expediente_info
+
+# Descarga un expediente por HTTP, devuelve None si la página necesita el navegador
+def descarga_expediente_http(args: Any, cab: Dict[str, Any]) -> Dict[str, Any]|None:
+    respuesta = http_fetch.descarga_html_condicional(cab["url de descarga"], args)
+    if respuesta is None or not extractor_html.contiene_detalle(respuesta.texto):
+        return None
+    return expediente_desde_html(cab, respuesta.texto, respuesta.etag, respuesta.last_modified)
+
+# Descarga un expediente cargando la página en el navegador
+def descarga_expediente_selenium(driver: WebDriver, args: Any, cab: Dict[str, Any]) -> Dict[str, Any]:
+    with limitador(cab["url de descarga"], args).peticion():
+        driver.get(cab["url de descarga"])
+        WebDriverWait(driver, args.patience).until(
+            EC.presence_of_element_located((By.ID, extractor_html.TABLA_DETALLE))
+        )
+    registra_pagina(driver)
+    # Una única lectura del DOM, los campos se extraen del HTML sin más llamadas al navegador
+    return expediente_desde_html(cab, driver.page_source)
+
+# Extrae la información completa de los expedientes, con solo_navegador se omite la descarga HTTP
+def recopila_expedientes(driver: WebDriver, args: Any, lista_cabeceras: List[Dict[str, Any]], solo_navegador: bool = False) -> List[Dict[str, Any]]:
     lista_expedientes = []
     # Itera sobre la lista de cabeceras para extraer la información de los expedientes
     for cab in lista_cabeceras:
         try:
-            driver.get(cab["url de descarga"])
-            file_content = driver.page_source
-            WebDriverWait(driver, args.patience).until(
-                EC.presence_of_element_located((By.ID, "DetalleLicitacionVIS_UOE"))
-            )
-            date = extract_fecha(driver)
-            expediente_info = {
-                "url de descarga": cab["url de descarga"],
-                "Timetrack": datetime.datetime.now(),
-                "Nombre del expediente": cab["Nombre del expediente"],
-                "Página HTML": bytearray(file_content,'utf-8'),
-                "fecha_anuncio": date
-            }
-            expediente_info.update(extract_table_info(driver, "DetalleLicitacionVIS_UOE"))
-            expediente_info.update(extract_table_info(driver, "InformacionLicitacionVIS_UOE", skip_first=True))
+            expediente_info = None
+            if args.fetch == "http" and not solo_navegador:
+                expediente_info = descarga_expediente_http(args, cab)
+            # Si no se usa HTTP o la página necesita JavaScript se descarga con el navegador
+            if expediente_info is None:
+                expediente_info = descarga_expediente_selenium(driver, args, cab)
             
             lista_expedientes.append(expediente_info)
 
         except Exception as e:
-            logging.error("Error al abrir el expediente %s: %s", cab[0], e)
+            logging.error("Error al abrir el expediente %s: %s", cab["Nombre del expediente"], e)
         #bar1.next()
 
    #bar1.finish()
     return lista_expedientes  
 
-def extract_fecha(driver: WebDriver) -> str|None:
+# Descarga un expediente por HTTP si está activado o con un navegador del pool en otro caso
+def descarga_expediente(args: Any, cab: Dict[str, Any], pool: DriverPool) -> Dict[str, Any]:
+    if args.fetch == "http":
+        expediente_info = descarga_expediente_http(args, cab)
+        if expediente_info is not None:
+            return expediente_info
+    with pool.navegador() as driver:
+        return descarga_expediente_selenium(driver, args, cab)
+
+# Recorre los enlaces con un número acotado de trabajadores y devuelve [link, resultado] según terminan
+def _itera_organos(args: Any, recopila, pool: Optional[DriverPool] = None, links: Optional[List[str]] = None) -> Iterator[List[Any]]:
+    links = args.links if links is None else links
+    # Si no se comparte un pool se crea uno propio para esta recopilación
+    pool_propio = pool is None
+    if pool_propio:
+        pool = DriverPool(args)
+    workers = max(1, args.workers)
     try:
-        row = driver.find_element(By.CLASS_NAME, "rowClass1 ")
-        date = row.find_element(By.TAG_NAME, "div").text.strip()
-    except:
-        date = None
-    return date
-
-# Extra información de una tabla específica de la página web
-def extract_table_info(driver: WebDriver, table_id: str, skip_first: bool = False) -> Dict[str, str]:
-    info = {}
-    table = driver.find_element(By.ID, table_id)
-    table_list = table.find_elements(By.TAG_NAME, 'ul')
-    # Salta el título de la tabla
-    if skip_first:
-        table_list = table_list[1:]
-    # Itera sobre la tabla para extraer los datos y rellena el diccionario del expediente
-    for t in table_list:
-        tab_line = t.find_elements(By.TAG_NAME, 'li')
-        if len(tab_line) >= 2:
-            browser_key = tab_line[0].find_element(By.TAG_NAME, 'span').get_attribute('title').strip()
-            browser_answ = tab_line[1].find_element(By.TAG_NAME, 'span').get_attribute('title').strip()
-            info[browser_key] = browser_answ    
-    return info
-
-# Recopila las licitaciones
-def collect_licitaciones(args: Any) -> List[Dict[str, Any]]:
-    expedientes_por_organo = []
+        if workers == 1:
+            for link in links:
+                yield [link, recopila(link, args, pool)]
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futuros = {executor.submit(recopila, link, args, pool): link for link in links}
+            for futuro in as_completed(futuros):
+                yield [futuros[futuro], futuro.result()]
+    finally:
+        if pool_propio:
+            pool.cierra()
+
+# Navega al perfil del contratante respetando el ritmo de peticiones del servidor
+def _abre_perfil(driver: WebDriver, link: str, args: Any):
+    with limitador(link, args).peticion():
+        driver.get(link)
+    registra_pagina(driver)
+
+# Recopila las cabeceras de un órgano, aislando los errores para no bloquear al resto.
+# Con una frontera, el órgano se reclama antes de recorrerlo y cada página se guarda en ella al terminarla.
+# al_terminar_pagina recibe el enlace, el número de páginas recorridas y las cabeceras de cada página en cuanto se leen.
+# Devuelve las cabeceras y si la paginación llegó a su final; si no, el órgano queda con error en la frontera para continuarlo
+def _cabeceras_organo(link: str, args: Any, pool: DriverPool, conocidas: Optional[Set[Tuple[str, str]]] = None,
+                      frontera: Optional[Frontera] = None,
+                      al_terminar_pagina: Optional[Callable[[str, int, List[Dict[str, Any]]], None]] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    pagina_inicial = 0
+    if frontera is not None:
+        pagina_inicial = frontera.reclama_organo(link)
+        if pagina_inicial is None:
+            return [], False
+
+    def guarda_pagina(pagina: int, cabeceras: List[Dict[str, Any]]):
+        if frontera is not None:
+            frontera.guarda_pagina(link, pagina, cabeceras)
+        if al_terminar_pagina is not None:
+            al_terminar_pagina(link, pagina, cabeceras)
+
+    try:
+        with pool.navegador() as driver:
+            _abre_perfil(driver, link, args)
+            lista_cabeceras = recopila_cabeceras(driver, args, conocidas, pagina_inicial, guarda_pagina)
+    except RecorridoIncompleto as e:
+        logging.error("Recorrido incompleto del perfil %s: %s", link, e)
+        if frontera is not None:
+            frontera.falla_organo(link)
+        return e.cabeceras, False
+    except Exception as e:
+        logging.error("Error al recopilar las cabeceras del perfil %s: %s", link, e)
+        if frontera is not None:
+            frontera.falla_organo(link)
+        return [], False
+
+    if frontera is not None:
+        frontera.completa_organo(link)
+    return lista_cabeceras, True
+
+# Recopila las licitaciones completas de un órgano, aislando los errores para no bloquear al resto.
+# Cada expediente se entrega a al_descargar en cuanto se descarga, sin acumular las páginas del órgano en memoria
+def _licitaciones_organo(link: str, args: Any, pool: DriverPool, al_descargar: Callable[[str, Dict[str, Any]], None]) -> int:
+    descargados = 0
+    try:
+        with pool.navegador() as driver:
+            _abre_perfil(driver, link, args)
+            try:
+                cabeceras = recopila_cabeceras(driver, args)
+            except RecorridoIncompleto as e:
+                # Se descargan las licitaciones de las páginas que sí se han leído
+                logging.error("Recorrido incompleto del perfil %s: %s", link, e)
+                cabeceras = e.cabeceras
+            for cab in cabeceras:
+                for expediente in recopila_expedientes(driver, args, [cab]):
+                    al_descargar(link, expediente)
+                    descargados += 1
+    except Exception as e:
+        logging.error("Error al recopilar las licitaciones del perfil %s: %s", link, e)
+    return descargados
+
+# Itera sobre las cabeceras de cada órgano a medida que se van recopilando, como [enlace, cabeceras, completo],
+# donde completo indica si la paginación del órgano llegó a su final.
+# conocidas asocia a cada enlace las cabeceras ya almacenadas; los enlaces que no aparecen se recorren completos.
+# Con una frontera solo se recorren los órganos pendientes en ella
+def itera_cabeceras(args: Any, pool: Optional[DriverPool] = None,
+                    conocidas: Optional[Dict[str, Set[Tuple[str, str]]]] = None,
+                    frontera: Optional[Frontera] = None,
+                    al_terminar_pagina: Optional[Callable[[str, int, List[Dict[str, Any]]], None]] = None) -> Iterator[List[Any]]:
+    conocidas = conocidas or {}
+    links = frontera.organos_pendientes() if frontera is not None else None
+    recopila = lambda link, args, pool: _cabeceras_organo(link, args, pool, conocidas.get(link), frontera, al_terminar_pagina)
+    for link, (cabeceras, completo) in _itera_organos(args, recopila, pool, links):
+        yield [link, cabeceras, completo]
+
+# Recopila las licitaciones entregando cada expediente a al_descargar(link, expediente) según se descarga.
+# Con varios trabajadores al_descargar se llama desde distintos hilos
+def recorre_licitaciones(args: Any, al_descargar: Callable[[str, Dict[str, Any]], None], pool: Optional[DriverPool] = None):
+    recopila = lambda link, args, pool: _licitaciones_organo(link, args, pool, al_descargar)
     # Recopila licitaciones iterando sobre la lista de enlaces introducida por argumentos
-    for link in args.links:
+    for link, descargados in _itera_organos(args, recopila, pool):
         print(link)
-        driver = abrir_navegador(link, args)
-        lista_cabeceras = recopila_cabeceras(driver, args)
-        if lista_cabeceras:
-            expedientes_por_organo.append([link,recopila_expedientes(driver, args, lista_cabeceras)])
-        driver.quit()
+        logging.info("%d expedientes descargados del perfil %s", descargados, link)
+
+# Recopila las licitaciones en memoria, agrupadas por órgano
+def collect_licitaciones(args: Any, pool: Optional[DriverPool] = None) -> List[Dict[str, Any]]:
+    expedientes_por_organo = {}
+    recorre_licitaciones(args, lambda link, expediente: expedientes_por_organo.setdefault(link, []).append(expediente), pool)
 
-    return expedientes_por_organo
+    return [[link, expedientes] for link, expedientes in expedientes_por_organo.items()]
 
 # Recopila las cabeceras
-def collect_cabeceras(args) -> List[Dict[str, Any]]:
-    cabeceras_por_organo = []
-    for link in args.links:
-        driver = abrir_navegador(link,args)
-        cabeceras_por_organo.append([link, recopila_cabeceras(driver, args)])
-        driver.quit()
-        
-    return cabeceras_por_organo
+def collect_cabeceras(args, pool: Optional[DriverPool] = None) -> List[Dict[str, Any]]:
+    return [[link, cabeceras] for link, cabeceras, _ in itera_cabeceras(args, pool)]
 
 if __name__ == "__main__":
     args = read_params()
-    licitaciones = collect_licitaciones(args)
-    cabeceras = collect_cabeceras(args)
+    # Las dos recopilaciones comparten los mismos navegadores
+    with DriverPool(args) as pool:
+        recorre_licitaciones(args, lambda link, expediente: logging.info("Expediente descargado: %s", expediente["Nombre del expediente"]), pool)
+        cabeceras = collect_cabeceras(args, pool)
     print(cabeceras)
\ No newline at end of file
@@ -0,0 +1,63 @@
+import argparse
+import logging
+from typing import Tuple
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from blob_store import descomprime
+import storage
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Servidor local que sustituye a la plataforma sirviendo las páginas de detalle guardadas en la base de datos cruda.
+# Permite probar la descarga HTTP sin acceder a la red: raw_db.py -f http --mirror http://localhost:8000
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def read_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--database", type=str, default=storage.RAW_URL, help=f"URL de la base de datos cruda con las páginas guardadas (default={storage.RAW_URL})")
+    parser.add_argument("--port", type=int, default=8000, help="Puerto del servidor (default=8000)")
+
+    args = parser.parse_args()
+
+    return args
+
+# Busca la última página guardada cuya url termina exactamente en la ruta pedida, devuelve su hash y su HTML.
+# Se compara el final de la url en lugar de usar LIKE para que los % y _ de la ruta no actúen como comodines
+def busca_pagina(engine: Engine, ruta: str) -> Tuple[str, bytes]|None:
+    with engine.connect() as conn:
+        row = conn.execute(
+            text("SELECT b.hash, b.codec, b.datos FROM expedienteraw e JOIN htmlblob b ON b.hash = e.hash_html "
+                 "WHERE substr(e.url, length(e.url) - :largo + 1) = :ruta ORDER BY e.id DESC LIMIT 1"),
+            {"ruta": ruta, "largo": len(ruta)}
+        ).first()
+    return (row[0], descomprime(row[1], row[2])) if row else None
+
+def crea_handler(engine: Engine):
+    class PaginaGuardadaHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            encontrada = busca_pagina(engine, self.path)
+            if encontrada is None:
+                self.send_error(404, "Página no guardada")
+                return
+            # El hash de la página sirve de ETag para probar la revalidación con peticiones condicionales
+            etag = f'"{encontrada[0]}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            pagina = encontrada[1]
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(pagina)))
+            self.end_headers()
+            self.wfile.write(pagina)
+
+    return PaginaGuardadaHandler
+
+if __name__ == "__main__":
+    args = read_params()
+    server = ThreadingHTTPServer(("localhost", args.port), crea_handler(storage.engine(args.database)))
+    logging.info("Sirviendo las páginas de %s en http://localhost:%d", args.database, args.port)
+    server.serve_forever()
@@ -1,26 +1,29 @@
-from sqlmodel import Field, SQLModel, create_engine, Session, select, Relationship, Column, distinct
+from sqlmodel import Field, SQLModel, Session, select, update, func, col, Relationship, Column, distinct
 from pydantic.v1 import AnyUrl, validator
-from typing import Optional
+from typing import Any, Dict, Iterator, List, Tuple
+import argparse
+import logging
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+import pandas as pd
 from datetime import datetime
 import clean_db
 import raw_db
-import unidecode
-
-# Transforma en un formato de fecha válido
-def parse_date(date_str: str) -> Optional[datetime]:
-    if not date_str:
-        return None
-    date_str = date_str.strip()
-    print(date_str)
-    # Prueba distintos formatos de fecha
-    for date_format in ('%d/%m/%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
-        try:
-            return datetime.strptime(date_str, date_format)
-        except ValueError:
-            print("ERROR")
-            return None
-            continue
-    raise ValueError(f"El formato '{date_str}' no es válido")
+import storage
+import transformacion
+import entidades
+import agregados
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def read_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--full", action="store_true", help="Vuelve a procesar todos los expedientes recientes, no solo los añadidos desde la última carga")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Procesos que transforman los expedientes en paralelo, repartidos en rangos de ids (default=1)")
+
+    args = parser.parse_args()
+
+    return args
 
 # Convierte el str en int
 def parse_int(value: str, default: int = None) -> int:
@@ -29,165 +32,204 @@ def parse_int(value: str, default: int = None) -> int:
     except (ValueError, TypeError):
         return default
 
-# Convierte el str en float
-def parse_float(value: str, default: float = None) -> float:
-    try:
-        return float(value)
-    except (ValueError, TypeError):
-        return default
-
-# Normaliza el nombre del adjudicatario
-def normalize_string(input_string: str) -> str:
-    if not input_string:
-        return ""
-    normalized_string = input_string.upper()
-    #normalized_string = normalized_string.replace(',', ' ').replace('.', ' ')
-    #normalized_string = unidecode.unidecode(normalized_string)
-    #normalized_string = ' '.join(normalized_string.split())
-    
-    return normalized_string
-
 # Añade los nuevos organos de contratación
 def add_organos(session_clean: Session, session_raw: Session):
-    statement = select(distinct(raw_db.ExpedienteRaw.id_organo))
-    raw_organos = session_raw.exec(statement).all() # Lista de organos de la base de datos cruda
-    statement = select(distinct(clean_db.OrganoContratacion.id))
-    clean_organos = session_clean.exec(statement).all() # Lista de organos de la base de datos limpia
-
-    int_raw_organos = []
-    for i in raw_organos:
-        int_raw_organos.append(parse_int(i))
-
-    missing_organos = set(int_raw_organos) - set(clean_organos) # Lista de organos que faltan en la base limpia
-
-    for m in missing_organos:
-        statement = select(raw_db.ExpedienteRaw.organo_contratacion,raw_db.ExpedienteRaw.id_organo).where(raw_db.ExpedienteRaw.id_organo == m)
-        organos_data = session_raw.exec(statement).first()
-    
-        miss_org = clean_db.OrganoContratacion(
-                id=parse_int(organos_data.id_organo),
-                nombre=organos_data.organo_contratacion
-            )
-        session_clean.add(miss_org)
+    # Un nombre por órgano en una sola consulta agrupada
+    statement = (select(raw_db.ExpedienteRaw.id_organo, func.min(raw_db.ExpedienteRaw.organo_contratacion))
+                 .where(raw_db.ExpedienteRaw.id_organo != None)
+                 .group_by(raw_db.ExpedienteRaw.id_organo))
+    raw_organos = session_raw.exec(statement).all() # Organos de la base de datos cruda
+    statement = select(clean_db.OrganoContratacion.id)
+    clean_organos = set(session_clean.exec(statement).all()) # Organos de la base de datos limpia
+
+    missing_organos = {} # Organos que faltan en la base limpia
+    for id_organo, nombre in raw_organos:
+        id_int = parse_int(id_organo)
+        if id_int is not None and id_int not in clean_organos and id_int not in missing_organos:
+            missing_organos[id_int] = dict(id=id_int, nombre=nombre)
+
+    storage.carga_masiva(session_clean, clean_db.OrganoContratacion, list(missing_organos.values()))
     session_clean.commit()
 
 # Añade los nuevos adjudicatarios
 def add_adjudicatarios(session_clean: Session, session_raw: Session):
-    statement = select(distinct(raw_db.ExpedienteRaw.Adjudicatario))
+    statement = select(distinct(raw_db.ExpedienteRaw.Adjudicatario)).where(raw_db.ExpedienteRaw.Adjudicatario != None)
     raw_adj = session_raw.exec(statement).all() # Lista de Adjudicatarios en la base de datos cruda
     statement = select(distinct(clean_db.Adjudicatario.nombre))
-    clean_adj = session_clean.exec(statement).all() # Lista de adjudicatarios en la base de datos limpia
-
-    missing_adj = set(raw_adj) - set(clean_adj)
-
-    for m in missing_adj:
-        statement = select(raw_db.ExpedienteRaw.Adjudicatario).where(raw_db.ExpedienteRaw.Adjudicatario == m)
-        adj_data = session_raw.exec(statement).first()
-    
-        miss_adj = clean_db.Adjudicatario(
-                nombre = adj_data
-            )
-        session_clean.add(miss_adj)
-    session_clean.commit()
+    clean_adj = set(session_clean.exec(statement).all()) # Lista de adjudicatarios en la base de datos limpia
 
+    missing_adj = [dict(nombre=nombre) for nombre in raw_adj if nombre not in clean_adj]
+    storage.carga_masiva(session_clean, clean_db.Adjudicatario, missing_adj)
+    session_clean.commit()
 
-# Función para transformar y guardar expedientes en la nueva base de datos
-def transform_and_save_expedientes(session_clean: Session, session_raw: Session):
-    # Selecciona los expedientes actualizados de la base de datos original
-    statement = select(raw_db.ExpedienteRaw).where(raw_db.ExpedienteRaw.reciente == True)
-    expedientes_actualizados = session_raw.exec(statement).all()
-    
-    for exp in expedientes_actualizados:
-        # Comprobar si el expediente ya existe en la base de datos estandarizada
-        statement = select(clean_db.Expediente).where(clean_db.Expediente.nombre_exp == exp.nombre)
-        existing_exp = session_clean.exec(statement).first()
-        
-        # Transformar los datos al formato de la nueva base de datos
-        try:
-            tipo_contrato = exp.Tipo_de_Contrato if exp.Tipo_de_Contrato else None
-        except ValueError:
-            tipo_contrato = "nule"
-
-        if existing_exp:
-            # Comparar las fechas de "timetrack" para ver cuál es más reciente
-            if existing_exp.timetrack < exp.timetrack:
-                # Actualizar la entrada existente
-                existing_exp.route = exp.url
-                existing_exp.estado_lic = exp.estado
-                existing_exp.organo_contratacion = exp.organo_contratacion
-                existing_exp.fecha_anuncio = parse_date(exp.fecha_anuncio)
-                existing_exp.id_organo = parse_int(exp.id_organo)
-                existing_exp.objeto_contrato = exp.Objeto_del_contrato
-                existing_exp.financiacion_UE = exp.Financiacion_UE
-                existing_exp.presupuesto_sin_impuestos = parse_float(exp.Presupuesto_base_sin_impuestos)
-                existing_exp.valor_estimado = parse_float(exp.Valor_estimado)
-                existing_exp.tipo_contrato = tipo_contrato
-                existing_exp.codigo_CPV = exp.Codigo_CPV
-                existing_exp.lugar_ejecucion = exp.Lugar_de_Ejecucion
-                existing_exp.sistema_contratacion = exp.Sistema_de_contratacion
-                existing_exp.procedimiento = exp.Procedimiento_de_contratacion
-                existing_exp.tipo_tramitacion = exp.Tipo_de_tramitacion
-                existing_exp.metodo_presentacion = exp.Metodo_de_presentacion
-                existing_exp.fecha_fin_oferta = parse_date(exp.Fecha_fin_de_presentacion)
-                existing_exp.resultado = exp.Resultado
-                existing_exp.adjudicatario = exp.Adjudicatario
-                existing_exp.n_licitadores = parse_int(exp.Num_de_Licitadores)
-                existing_exp.importe_adjudicacion = parse_float(exp.Importe_de_Adjudicacion)
-                existing_exp.fecha_fin_solicitud = parse_date(exp.Fecha_fin_de_solicitud)
-                existing_exp.url = exp.url
-
-                print("-- ACTUALIZA UN EXPEDIENTE")
-                session_clean.add(existing_exp)  # Añadir el expediente actualizado a la sesión
-                session_clean.commit()
+# Número de expedientes por sentencia en la carga de la base de datos limpia
+TAM_BLOQUE = 1000
+
+# Consulta de los expedientes crudos recientes con id en (desde_id, hasta_id], solo con las columnas que se transforman
+def consulta_cruda(desde_id: int, hasta_id: int):
+    columnas = [getattr(raw_db.ExpedienteRaw, c) for c in transformacion.COLUMNAS_CRUDAS]
+    return select(*columnas).where(raw_db.ExpedienteRaw.reciente == True,
+                                   raw_db.ExpedienteRaw.id > desde_id, raw_db.ExpedienteRaw.id <= hasta_id)
+
+# Transforma por bloques los expedientes crudos que devuelve la consulta. Las filas se leen en streaming de TAM_BLOQUE
+# en TAM_BLOQUE (cursor de servidor en PostgreSQL), así que la memoria no crece con el tamaño de la base de datos cruda.
+# Devuelve cada bloque transformado con sus valores no convertidos por columna
+def transforma_expedientes(session_raw: Session, statement) -> Iterator[Tuple[List[Dict[str, Any]], Dict[str, int]]]:
+    resultado = session_raw.exec(statement.execution_options(yield_per=TAM_BLOQUE))
+    for bloque in resultado.partitions():
+        crudo = pd.DataFrame(bloque, columns=transformacion.COLUMNAS_CRUDAS)
+        limpio, fallos = transformacion.transforma_bloque(crudo)
+        yield transformacion.a_filas(limpio.drop(columns="id_raw")), fallos
+
+# Motor de la base de datos cruda de cada proceso del modo paralelo, se crea al arrancar el proceso
+_engine_raw = None
+
+def _inicia_proceso(url_raw: str):
+    global _engine_raw
+    _engine_raw = storage.crea_engine(url_raw)
+
+# Trabajo de un proceso del modo paralelo: transforma los expedientes recientes con id en (desde_id, hasta_id].
+# Los rangos son de TAM_BLOQUE ids, así que cada trabajo devuelve como mucho un bloque
+def transforma_rango(desde_id: int, hasta_id: int) -> Tuple[List[Dict[str, Any]], Counter]:
+    filas = []
+    fallos = Counter()
+    with Session(_engine_raw) as session_raw:
+        for filas_bloque, fallos_bloque in transforma_expedientes(session_raw, consulta_cruda(desde_id, hasta_id)):
+            filas.extend(filas_bloque)
+            fallos.update(fallos_bloque)
+    return filas, fallos
+
+# Reparte los rangos de ids entre los procesos y devuelve cada resultado según termina. Como mucho hay max_en_curso
+# trabajos enviados a la vez y cada futuro se suelta al leerlo, así que la memoria no crece con la base de datos cruda
+def transforma_en_paralelo(executor: ProcessPoolExecutor, rangos: Iterator[Tuple[int, int]], max_en_curso: int) -> Iterator[Tuple[List[Dict[str, Any]], Counter]]:
+    pendientes = set()
+    for desde_id, hasta_id in rangos:
+        pendientes.add(executor.submit(transforma_rango, desde_id, hasta_id))
+        if len(pendientes) >= max_en_curso:
+            hechos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+            for futuro in hechos:
+                yield futuro.result()
+    for futuro in as_completed(pendientes):
+        yield futuro.result()
+
+# Escribe en la base de datos limpia los expedientes transformados, sin hacer commit.
+# existentes: nombre -> (internal_id, timetrack) de los expedientes ya cargados, se actualiza con los insertados.
+# adjudicatarios: nombre -> internal_id, para enlazar cada expediente con su adjudicatario.
+# En tocados se anotan las claves de los agregados que cambian, tanto las anteriores como las nuevas de cada expediente.
+# Con completo=True también se reescriben los expedientes con el mismo timetrack que el cargado: reparse.py y las
+# correcciones de la transformación cambian las filas crudas sin tocar su timetrack
+def escribe_expedientes(session_clean: Session, existentes: Dict[str, Tuple[int, datetime]], adjudicatarios: Dict[str, int],
+                        filas: List[Dict[str, Any]], tocados: agregados.Tocados, completo: bool = False) -> Tuple[int, int]:
+    # Una fila por expediente: si la base de datos cruda tiene varias versiones recientes del mismo, la de timetrack mayor
+    ultimas: Dict[str, Dict[str, Any]] = {}
+    for exp in filas:
+        previa = ultimas.get(exp["nombre_exp"])
+        if previa is None or previa["timetrack"] < exp["timetrack"]:
+            ultimas[exp["nombre_exp"]] = exp
+
+    nuevos = []
+    actualizados = []
+    for exp in ultimas.values():
+        exp["adjudicatario_id"] = adjudicatarios.get(exp["adjudicatario"])
+        if exp["nombre_exp"] in existentes:
+            internal_id, timetrack = existentes[exp["nombre_exp"]]
+            # Solo se actualiza si la versión cruda es más reciente que la cargada, o igual de reciente en una carga completa
+            if timetrack < exp["timetrack"] or (completo and timetrack == exp["timetrack"]):
+                actualizados.append(dict(exp, internal_id=internal_id))
         else:
-            # Insertar un nuevo expediente
-            print("-- INSERTA NUEVO EXPEDIENTE")
-            nuevo_expediente = clean_db.Expediente(
-                nombre_exp=exp.nombre,
-                route=exp.url,
-                estado_lic=exp.estado,
-                fecha_anuncio=parse_date(exp.fecha_anuncio),
-                organo_contratacion = exp.organo_contratacion,
-                id_organo = parse_int(exp.id_organo),
-                objeto_contrato=exp.Objeto_del_contrato,
-                financiacion_UE=exp.Financiacion_UE,
-                presupuesto_sin_impuestos=parse_float(exp.Presupuesto_base_sin_impuestos),
-                valor_estimado=parse_float(exp.Valor_estimado),
-                tipo_contrato=tipo_contrato,
-                codigo_CPV=exp.Codigo_CPV,
-                lugar_ejecucion=exp.Lugar_de_Ejecucion,
-                sistema_contratacion=exp.Sistema_de_contratacion,
-                procedimiento=exp.Procedimiento_de_contratacion,
-                tipo_tramitacion=exp.Tipo_de_tramitacion,
-                metodo_presentacion=exp.Metodo_de_presentacion,
-                fecha_fin_oferta=parse_date(exp.Fecha_fin_de_presentacion),
-                resultado=exp.Resultado,
-                adjudicatario=exp.Adjudicatario,
-                n_licitadores=parse_int(exp.Num_de_Licitadores),
-                importe_adjudicacion=parse_float(exp.Importe_de_Adjudicacion),
-                fecha_fin_solicitud=parse_date(exp.Fecha_fin_de_solicitud),
-                url=exp.url
-            )
-            session_clean.add(nuevo_expediente)  # Añadir el nuevo expediente a la sesión
+            nuevos.append(exp)
+
+    tocados.añade_existentes(session_clean, [exp["internal_id"] for exp in actualizados])
+    tocados.añade(actualizados)
+    tocados.añade(nuevos)
+
+    # Actualizaciones por clave primaria e inserciones masivas en bloques
+    for i in range(0, len(actualizados), TAM_BLOQUE):
+        session_clean.execute(update(clean_db.Expediente), actualizados[i:i + TAM_BLOQUE])
+    for i in range(0, len(nuevos), TAM_BLOQUE):
+        storage.carga_masiva(session_clean, clean_db.Expediente, nuevos[i:i + TAM_BLOQUE])
+    # Claves de los insertados, para que un bloque posterior con el mismo expediente lo actualice por clave primaria
+    nombres = [exp["nombre_exp"] for exp in nuevos]
+    for i in range(0, len(nombres), TAM_BLOQUE):
+        statement = (select(clean_db.Expediente.nombre_exp, clean_db.Expediente.internal_id, clean_db.Expediente.timetrack)
+                     .where(col(clean_db.Expediente.nombre_exp).in_(nombres[i:i + TAM_BLOQUE])))
+        for nombre, internal_id, timetrack in session_clean.exec(statement):
+            existentes[nombre] = (internal_id, timetrack)
+    return len(nuevos), len(actualizados)
+
+# Función para transformar y guardar expedientes en la nueva base de datos.
+# Solo se procesan los expedientes crudos añadidos desde la carga anterior, salvo con completo=True.
+# Con workers > 1 los expedientes se transforman en paralelo por rangos de ids y este proceso es el único que escribe
+def transform_and_save_expedientes(session_clean: Session, session_raw: Session, completo: bool = False, workers: int = 1):
+    fuente = str(session_raw.get_bind().url)
+    estado = session_clean.get(clean_db.EstadoETL, fuente) or clean_db.EstadoETL(fuente=fuente)
+    # Nueva marca de agua: los expedientes que se añadan durante la carga quedan para la siguiente
+    ultimo_id, ultimo_timetrack = session_raw.exec(select(func.max(raw_db.ExpedienteRaw.id), func.max(raw_db.ExpedienteRaw.timetrack))).one()
+    if ultimo_id is None:
+        return
+    desde_id = 0 if completo else estado.ultimo_id
+
+    # Claves de los expedientes ya cargados en la base de datos estandarizada, en una sola consulta
+    statement = select(clean_db.Expediente.nombre_exp, clean_db.Expediente.internal_id, clean_db.Expediente.timetrack)
+    existentes = {nombre: (internal_id, timetrack) for nombre, internal_id, timetrack in session_clean.exec(statement).all()}
+    adjudicatarios = dict(session_clean.exec(select(clean_db.Adjudicatario.nombre, clean_db.Adjudicatario.internal_id)).all())
+
+    insertados = 0
+    actualizados = 0
+    fallos = Counter()
+    tocados = agregados.Tocados()
+    if workers > 1:
+        url_raw = session_raw.get_bind().url.render_as_string(hide_password=False)
+        rangos = ((desde, min(desde + TAM_BLOQUE, ultimo_id)) for desde in range(desde_id, ultimo_id, TAM_BLOQUE))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_inicia_proceso, initargs=(url_raw,)) as executor:
+            for filas, fallos_bloque in transforma_en_paralelo(executor, rangos, workers * 2):
+                fallos.update(fallos_bloque)
+                n_nuevos, n_actualizados = escribe_expedientes(session_clean, existentes, adjudicatarios, filas, tocados, completo)
+                insertados += n_nuevos
+                actualizados += n_actualizados
+                # Commit por bloque con sus agregados: si la carga se interrumpe, la siguiente repite sin duplicar lo ya escrito
+                agregados.recalcula(session_clean, tocados)
+                session_clean.commit()
+    else:
+        # Cada bloque se escribe según se transforma, sin acumular la base de datos entera en memoria
+        for filas, fallos_bloque in transforma_expedientes(session_raw, consulta_cruda(desde_id, ultimo_id)):
+            fallos.update(fallos_bloque)
+            n_nuevos, n_actualizados = escribe_expedientes(session_clean, existentes, adjudicatarios, filas, tocados, completo)
+            insertados += n_nuevos
+            actualizados += n_actualizados
+    transformacion.informa_fallos(fallos)
+    if completo or agregados.faltan_agregados(session_clean):
+        agregados.reconstruye(session_clean)
+    else:
+        agregados.recalcula(session_clean, tocados)
+
+    # La marca de agua avanza en la misma transacción que los últimos expedientes
+    estado.ultimo_id = ultimo_id
+    estado.ultimo_timetrack = ultimo_timetrack
+    estado.actualizado = datetime.now()
+    session_clean.add(estado)
     session_clean.commit()  # Confirmar los cambios en la base de datos
+    logging.info("Expedientes insertados: %d, actualizados: %d", insertados, actualizados)
 
 
-def main():
+def main(args):
     # Crear el motor de base de datos y la sesión
-    engine_clean = create_engine("sqlite:///clean_database.db")
-    engine_raw = create_engine("sqlite:///raw_database.db")
+    engine_clean = clean_db.connect_db()
+    engine_raw = raw_db.connect_db()
 
     session_clean = Session(engine_clean)
     session_raw = Session(engine_raw)
 
     add_organos(session_clean, session_raw)
     add_adjudicatarios(session_clean,session_raw)
-    transform_and_save_expedientes(session_clean, session_raw)
+    entidades.resuelve_adjudicatarios(session_clean)
+    transform_and_save_expedientes(session_clean, session_raw, args.full, args.workers)
 
     session_clean.close()
     session_raw.close()
 
 
 if __name__ == "__main__":
-    main()
+    args = read_params()
+    main(args)
 
@@ -0,0 +1,110 @@
+import logging
+from typing import Any, Dict, List, Tuple
+import numpy as np
+import pandas as pd
+
+# Conversión por bloques de los expedientes crudos (todo texto) a los tipos de la base de datos limpia.
+# Cada columna se convierte de una vez con pandas en lugar de campo a campo
+
+# Columnas crudas -> columnas limpias según el tipo de conversión
+CAMPOS_TEXTO = {
+    "nombre": "nombre_exp",
+    "estado": "estado_lic",
+    "organo_contratacion": "organo_contratacion",
+    "Objeto_del_contrato": "objeto_contrato",
+    "Financiacion_UE": "financiacion_UE",
+    "Tipo_de_Contrato": "tipo_contrato",
+    "Codigo_CPV": "codigo_CPV",
+    "Lugar_de_Ejecucion": "lugar_ejecucion",
+    "Sistema_de_contratacion": "sistema_contratacion",
+    "Procedimiento_de_contratacion": "procedimiento",
+    "Tipo_de_tramitacion": "tipo_tramitacion",
+    "Metodo_de_presentacion": "metodo_presentacion",
+    "Resultado": "resultado",
+    "Adjudicatario": "adjudicatario",
+}
+CAMPOS_FECHA = {
+    "fecha_anuncio": "fecha_anuncio",
+    "Fecha_fin_de_presentacion": "fecha_fin_oferta",
+    "Fecha_fin_de_solicitud": "fecha_fin_solicitud",
+}
+CAMPOS_DECIMAL = {
+    "Presupuesto_base_sin_impuestos": "presupuesto_sin_impuestos",
+    "Valor_estimado": "valor_estimado",
+    "Importe_de_Adjudicacion": "importe_adjudicacion",
+}
+CAMPOS_ENTERO = {
+    "id_organo": "id_organo",
+    "Num_de_Licitadores": "n_licitadores",
+}
+# Columnas crudas que necesita la transformación
+COLUMNAS_CRUDAS = ["id", "timetrack", "url"] + list(CAMPOS_TEXTO) + list(CAMPOS_FECHA) + list(CAMPOS_DECIMAL) + list(CAMPOS_ENTERO)
+
+# Formatos de fecha que aparecen en la plataforma y en las bases de datos, en el orden en que se prueban
+FORMATOS_FECHA = ('%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%d/%m/%Y', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+# Textos de la plataforma que equivalen a un valor vacío
+VALORES_VACIOS = ["", "Ver detalle de la adjudicación"]
+
+# Limpia espacios y convierte en nulos los valores vacíos
+def limpia_texto(serie: pd.Series) -> pd.Series:
+    serie = serie.astype("string").str.strip()
+    return serie.mask(serie.isin(VALORES_VACIOS))
+
+# Convierte una columna de fechas probando cada formato con los valores que aún no se han podido convertir
+def convierte_fechas(serie: pd.Series) -> pd.Series:
+    serie = limpia_texto(serie)
+    fechas = pd.Series(pd.NaT, index=serie.index, dtype="datetime64[ns]")
+    for formato in FORMATOS_FECHA:
+        pendientes = fechas.isna() & serie.notna()
+        if not pendientes.any():
+            break
+        fechas[pendientes] = pd.to_datetime(serie[pendientes], format=formato, errors="coerce")
+    return fechas
+
+# Convierte importes con formato español ("1.234,56 €", "12.000 EUR") o con punto decimal ("1234.5")
+def convierte_decimales(serie: pd.Series) -> pd.Series:
+    serie = limpia_texto(serie).str.replace(r"[^\d,.\-]", "", regex=True)
+    # Con coma decimal, los puntos son separadores de miles. Sin coma también lo son si hay
+    # varios puntos o si cada punto va seguido de grupos de tres cifras ("12.000")
+    miles = (serie.str.contains(",", regex=False) | (serie.str.count(r"\.") > 1)
+             | serie.str.fullmatch(r"-?\d{1,3}(\.\d{3})+")).fillna(False).astype(bool)
+    normalizada = serie.mask(miles, serie.str.replace(".", "", regex=False))
+    normalizada = normalizada.str.replace(",", ".", regex=False)
+    return pd.to_numeric(normalizada, errors="coerce").astype("float64")
+
+# Convierte a entero, los valores con decimales se consideran erróneos
+def convierte_enteros(serie: pd.Series) -> pd.Series:
+    numeros = pd.to_numeric(limpia_texto(serie), errors="coerce").astype("float64")
+    return numeros.where(np.isclose(numeros, np.round(numeros))).astype("Int64")
+
+# Número de valores no vacíos que no se han podido convertir
+def _fallos(original: pd.Series, convertida: pd.Series) -> int:
+    return int((limpia_texto(original).notna() & convertida.isna()).sum())
+
+# Transforma un bloque de expedientes crudos (una fila por expediente, columnas de COLUMNAS_CRUDAS).
+# Devuelve el bloque con las columnas limpias y el número de valores no convertidos por columna
+def transforma_bloque(crudo: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    limpio = pd.DataFrame(index=crudo.index)
+    fallos = {}
+    limpio["id_raw"] = crudo["id"]
+    limpio["timetrack"] = pd.to_datetime(crudo["timetrack"])
+    limpio["route"] = limpia_texto(crudo["url"])
+    limpio["url"] = limpio["route"]
+    for origen, destino in CAMPOS_TEXTO.items():
+        limpio[destino] = limpia_texto(crudo[origen])
+    for campos, convierte in ((CAMPOS_FECHA, convierte_fechas), (CAMPOS_DECIMAL, convierte_decimales), (CAMPOS_ENTERO, convierte_enteros)):
+        for origen, destino in campos.items():
+            limpio[destino] = convierte(crudo[origen])
+            fallos[destino] = _fallos(crudo[origen], limpio[destino])
+    return limpio, fallos
+
+# Filas del bloque como diccionarios con tipos de Python y None en lugar de NaN/NaT
+def a_filas(limpio: pd.DataFrame) -> List[Dict[str, Any]]:
+    return limpio.astype(object).where(limpio.notna(), None).to_dict("records")
+
+# Muestra el resumen de valores no convertidos por columna
+def informa_fallos(fallos: Dict[str, int]):
+    for columna, n in fallos.items():
+        if n:
+            logging.warning("Columna %s: %d valores no se han podido convertir", columna, n)
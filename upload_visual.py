@@ -3,9 +3,10 @@ from dash import dcc, html, dash_table
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output
 import plotly.graph_objects as go
-from sqlmodel import create_engine, Session, select
+from sqlmodel import Session, select
 import pandas as pd
-from clean_db import OrganoContratacion, Expediente, Adjudicatario  # Asegúrate de importar tus modelos
+import storage
+from clean_db import OrganoContratacion, Expediente, Adjudicatario, TotalOrganoAdjudicatario, TotalOrganoMes, TotalCPV, TotalProcedimiento  # Asegúrate de importar tus modelos
 
 # Función para obtener los X expedientes más caros de un órgano de contratación específico
 def get_top_expedientes_mas_caros(session, organo_id, limit):
@@ -49,33 +50,53 @@ def get_adjudicatarios():
 
 # Función para obtener todos los expedientes de un adjudicatario específico
 def get_expedientes_por_adjudicatario(session, adjudicatario):
-    statement = select(Expediente).where(Expediente.adjudicatario == adjudicatario)
+    statement = (select(Expediente)
+                 .join(Adjudicatario, Expediente.adjudicatario_id == Adjudicatario.internal_id)
+                 .where(Adjudicatario.nombre == adjudicatario))
     expedientes = session.exec(statement).all()
     data = [exp.model_dump() for exp in expedientes]
     return pd.DataFrame(data)
 
-def get_total_por_adjudicatario(session: Session, organo_id: int):
-    # Seleccionar todos los expedientes para un órgano de contratación específico
-    statement = select(Expediente).where(Expediente.id_organo == organo_id)
-    expedientes = session.exec(statement).all()
-
-    # Crear un DataFrame a partir de los expedientes
-    data = [exp.dict() for exp in expedientes]
-    df = pd.DataFrame(data)
-
-    if df.empty:
-        return []
+# Importe total recibido por cada adjudicatario de un órgano de contratación, de mayor a menor,
+# leído de los totales que mantiene la carga en lugar de agrupar todos los expedientes del órgano
+def get_total_por_adjudicatario(session: Session, organo_id: int, limit: int = None):
+    statement = (
+        select(Adjudicatario.nombre, TotalOrganoAdjudicatario.importe_total)
+        .join(Adjudicatario, TotalOrganoAdjudicatario.adjudicatario_id == Adjudicatario.internal_id)
+        .where(TotalOrganoAdjudicatario.id_organo == organo_id)
+        .order_by(TotalOrganoAdjudicatario.importe_total.desc().nulls_last())
+        .limit(limit)
+    )
+    totales = session.exec(statement).all()
+    return pd.DataFrame(totales, columns=['adjudicatario', 'importe_adjudicacion'])
 
-    # Agrupar por adjudicatario y sumar los importes adjudicados
-    total_por_adjudicatario = df.groupby('adjudicatario')['importe_adjudicacion'].sum().reset_index()
+# Número de expedientes e importe adjudicado de un órgano por mes de anuncio, leídos de los totales de la carga
+def get_totales_por_mes(session: Session, organo_id: int):
+    statement = (
+        select(TotalOrganoMes.anio, TotalOrganoMes.mes, TotalOrganoMes.num_expedientes, TotalOrganoMes.importe_total)
+        .where(TotalOrganoMes.id_organo == organo_id)
+        .order_by(TotalOrganoMes.anio, TotalOrganoMes.mes)
+    )
+    df = pd.DataFrame(session.exec(statement).all(), columns=['anio', 'mes', 'num_expedientes', 'importe_total'])
+    df['periodo'] = df['anio'].astype(str) + '-' + df['mes'].astype(str).str.zfill(2)
+    return df
 
-    # Ordenar de mayor a menor
-    total_por_adjudicatario = total_por_adjudicatario.sort_values(by='importe_adjudicacion', ascending=False)
+# Códigos CPV con mayor importe adjudicado
+def get_totales_por_cpv(session: Session, limit: int = 15):
+    statement = (
+        select(TotalCPV.codigo_CPV, TotalCPV.num_expedientes, TotalCPV.importe_total)
+        .order_by(TotalCPV.importe_total.desc().nulls_last())
+        .limit(limit)
+    )
+    return pd.DataFrame(session.exec(statement).all(), columns=['codigo_CPV', 'num_expedientes', 'importe_total'])
 
-    return total_por_adjudicatario
+# Expedientes e importe adjudicado por procedimiento de contratación
+def get_totales_por_procedimiento(session: Session):
+    statement = select(TotalProcedimiento.procedimiento, TotalProcedimiento.num_expedientes, TotalProcedimiento.importe_total)
+    return pd.DataFrame(session.exec(statement).all(), columns=['procedimiento', 'num_expedientes', 'importe_total'])
 
 # Crear el motor de base de datos y la sesión
-engine = create_engine("sqlite:///cleandata.db")
+engine = storage.engine(storage.CLEAN_URL)
 
 # Función para obtener todos los órganos de contratación
 def fetch_organos():
@@ -141,7 +162,8 @@ app.layout = html.Div(style={'backgroundColor': '#f9f9f9', 'font-family': 'Ruda,
                     html.Li("Top Expedientes Más Caros: Visualice los expedientes con mayor importe de adjudicación para un órgano de contratación específico.", style={'fontSize': '16px'}),
                     html.Li("Últimos Contratos: Consulte los contratos más recientes y filtre por órgano de contratación y estado del expediente.", style={'fontSize': '16px'}),
                     html.Li("Buscar por Adjudicatario: Encuentre todos los expedientes asociados a un adjudicatario específico.", style={'fontSize': '16px'}),
-                    html.Li("Total Recibido por Adjudicatario: Vea el importe total recibido por cada adjudicatario para un órgano de contratación específico.", style={'fontSize': '16px'})
+                    html.Li("Total Recibido por Adjudicatario: Vea el importe total recibido por cada adjudicatario para un órgano de contratación específico.", style={'fontSize': '16px'}),
+                    html.Li("Resumen: Vea la evolución mensual de un órgano de contratación y los totales por código CPV y por procedimiento.", style={'fontSize': '16px'})
                 ])
             ])
         ]),
@@ -271,6 +293,31 @@ app.layout = html.Div(style={'backgroundColor': '#f9f9f9', 'font-family': 'Ruda,
             ),
 
             #html.Div(id='total-adjudicatarios-details', style={'width': '80%', 'margin': '20px auto', 'padding': '20px', 'backgroundColor': '#ffffff', 'borderRadius': '5px', 'boxShadow': '0 4px 8px rgba(0,0,0,0.1)'})
+        ]),
+
+        dcc.Tab(label='Resumen', value='tab-5', children=[
+            html.Div(style={'textAlign': 'center', 'margin': '20px'}, children=[
+                html.Label('Selecciona un Órgano de Contratación:', style={'fontSize': '20px', 'marginBottom': '10px'}),
+                dcc.Dropdown(
+                    id='organo-resumen-dropdown',
+                    options=organo_options,
+                    value=None,
+                    style={'width': '50%', 'margin': '0 auto'}
+                )
+            ]),
+
+            dcc.Graph(
+                id='totales-mes-graph',
+                style={'width': '80%', 'margin': '0 auto', 'backgroundColor': '#ffffff', 'padding': '20px', 'borderRadius': '5px', 'boxShadow': '0 4px 8px rgba(0,0,0,0.1)'}
+            ),
+            dcc.Graph(
+                id='totales-cpv-graph',
+                style={'width': '80%', 'margin': '20px auto', 'backgroundColor': '#ffffff', 'padding': '20px', 'borderRadius': '5px', 'boxShadow': '0 4px 8px rgba(0,0,0,0.1)'}
+            ),
+            dcc.Graph(
+                id='totales-procedimiento-graph',
+                style={'width': '80%', 'margin': '20px auto', 'backgroundColor': '#ffffff', 'padding': '20px', 'borderRadius': '5px', 'boxShadow': '0 4px 8px rgba(0,0,0,0.1)'}
+            )
         ])
 
     ])
@@ -537,12 +584,11 @@ def update_total_adjudicatarios_graph(organo_id, num_empresas):
         num_empresas = 10  # Valor por defecto si no se especifica uno válido
 
     with Session(engine) as session:
-        df = get_total_por_adjudicatario(session, organo_id)
+        df = get_total_por_adjudicatario(session, organo_id, num_empresas)
 
     if df.empty:
         fig = go.Figure().update_layout(title='No hay datos disponibles')
     else:
-        df = df.head(num_empresas)
         fig = go.Figure(data=[go.Bar(x=df['importe_adjudicacion'], y=df['adjudicatario'], orientation='h', marker=dict(color='#4CAF50'))])
         fig.update_layout(
             title='Total Recibido por Adjudicatario',
@@ -557,6 +603,73 @@ def update_total_adjudicatarios_graph(organo_id, num_empresas):
 
     return fig
 
+# Callback para el gráfico mensual de la pestaña de resumen
+@app.callback(
+    Output('totales-mes-graph', 'figure'),
+    Input('organo-resumen-dropdown', 'value')
+)
+def update_totales_mes_graph(organo_id):
+    if not organo_id:
+        return go.Figure().update_layout(title='Selecciona un órgano de contratación para ver los datos.')
+
+    with Session(engine) as session:
+        df = get_totales_por_mes(session, organo_id)
+
+    if df.empty:
+        return go.Figure().update_layout(title='No hay datos disponibles')
+    fig = go.Figure(data=[go.Bar(x=df['periodo'], y=df['importe_total'], customdata=df['num_expedientes'], marker=dict(color='#4CAF50'))])
+    fig.update_layout(
+        title='Importe Adjudicado por Mes de Anuncio',
+        xaxis_title='Mes',
+        yaxis_title='Importe de Adjudicación',
+        plot_bgcolor='#ffffff',
+        paper_bgcolor='#f9f9f9',
+        font=dict(color='#333333', size=14)
+    )
+    fig.update_traces(hovertemplate='Mes: %{x}<br>Importe: %{y}<br>Expedientes: %{customdata}')
+    return fig
+
+# Callback para los gráficos por CPV y por procedimiento, que no dependen del órgano y se cargan al abrir la pestaña
+@app.callback(
+    [Output('totales-cpv-graph', 'figure'),
+     Output('totales-procedimiento-graph', 'figure')],
+    Input('tabs', 'value')
+)
+def update_totales_generales_graphs(tab):
+    if tab != 'tab-5':
+        return go.Figure(), go.Figure()
+
+    with Session(engine) as session:
+        df_cpv = get_totales_por_cpv(session)
+        df_proc = get_totales_por_procedimiento(session)
+
+    if df_cpv.empty:
+        fig_cpv = go.Figure().update_layout(title='No hay datos disponibles')
+    else:
+        fig_cpv = go.Figure(data=[go.Bar(x=df_cpv['importe_total'], y=df_cpv['codigo_CPV'], customdata=df_cpv['num_expedientes'], orientation='h', marker=dict(color='#75B2B4'))])
+        fig_cpv.update_layout(
+            title='Códigos CPV con Mayor Importe Adjudicado',
+            xaxis_title='Importe de Adjudicación',
+            yaxis_title='Código CPV',
+            yaxis=dict(categoryorder='total ascending'),
+            plot_bgcolor='#ffffff',
+            paper_bgcolor='#f9f9f9',
+            font=dict(color='#333333', size=14)
+        )
+        fig_cpv.update_traces(hovertemplate='CPV: %{y}<br>Importe: %{x}<br>Expedientes: %{customdata}')
+
+    if df_proc.empty:
+        fig_proc = go.Figure().update_layout(title='No hay datos disponibles')
+    else:
+        fig_proc = go.Figure(data=[go.Pie(labels=df_proc['procedimiento'], values=df_proc['num_expedientes'])])
+        fig_proc.update_layout(
+            title='Expedientes por Procedimiento de Contratación',
+            paper_bgcolor='#f9f9f9',
+            font=dict(color='#333333', size=14)
+        )
+
+    return fig_cpv, fig_proc
+
 server = app.server
 
 if __name__ == '__main__':